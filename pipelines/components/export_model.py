@@ -0,0 +1,147 @@
+import os
+from typing import NamedTuple
+
+import google_cloud_pipeline_components
+import kfp
+from google.cloud import aiplatform
+from google.cloud.aiplatform import gapic as aip
+from google.cloud.aiplatform import pipeline_jobs
+from google.protobuf.json_format import MessageToDict
+from google_cloud_pipeline_components import aiplatform as aip_components
+from google_cloud_pipeline_components.experimental import custom_job
+from kfp.v2 import compiler, dsl
+from kfp.v2.dsl import Input, Metrics, Model, Output, component
+
+
+@component(
+    base_image="python:3.9",
+    packages_to_install=["torch", "transformers", "sentencepiece", "onnx", "onnxruntime"],
+    output_component_file="./pipelines/yaml/export_model.yaml",
+)
+def export_model(
+    model_display_name: str,
+    model: Input[Model],
+    exported_model: Output[Model],
+    metrics: Output[Metrics],
+    export_formats: str = "torchscript,onnx",
+    tolerance: float = 1e-3,
+) -> NamedTuple("Outputs", [("exported_files", list)]):
+    """custom pipeline component to export the trained model to a traced
+    TorchScript module (model.pt) and/or an ONNX graph (model.onnx) with
+    dynamic batch and sequence axes, next to the original artifacts.
+
+    Each export is checked for equivalence with the eager model on batches
+    of different shapes, and the component fails when the logits differ
+    by more than `tolerance`.
+    """
+    import logging
+    import os
+    import shutil
+    from collections import namedtuple
+
+    import numpy as np
+    import torch
+    from transformers import BertForSequenceClassification, XLMRobertaTokenizerFast
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    model_artifacts_dir = f"{model.path}/model/{model_display_name}"
+    export_dir = f"{exported_model.path}/model/{model_display_name}"
+    os.makedirs(export_dir, exist_ok=True)
+
+    # carry over the artifacts of the trained model
+    artifact_files = model.metadata.get("artifact_files") or os.listdir(model_artifacts_dir)
+    for f in artifact_files:
+        shutil.copyfile(os.path.join(model_artifacts_dir, f), os.path.join(export_dir, f))
+
+    # load the eager model in torchscript mode so that it returns tuples
+    eager_model = BertForSequenceClassification.from_pretrained(
+        model_artifacts_dir, torchscript=True
+    ).eval()
+    tokenizer = XLMRobertaTokenizerFast.from_pretrained(model_artifacts_dir)
+
+    # sample batches with different batch sizes and sequence lengths
+    texts = [
+        "Your parcel is on hold, confirm your address at the link below.",
+        "See you at dinner tonight!",
+        "Congratulations, you won a prize. Reply with your bank details to claim it now.",
+    ]
+    batches = [
+        tokenizer(texts[:1], padding="longest", return_tensors="pt"),
+        tokenizer(texts, padding="longest", return_tensors="pt"),
+        tokenizer(texts[1:], padding="max_length", max_length=128, return_tensors="pt"),
+    ]
+    with torch.no_grad():
+        expected = [
+            eager_model(b["input_ids"], b["attention_mask"])[0].numpy() for b in batches
+        ]
+
+    def check(name, run):
+        max_diff = max(
+            float(np.abs(run(b) - logits).max()) for b, logits in zip(batches, expected)
+        )
+        logging.info(f"{name} max logits difference to eager = {max_diff}")
+        metrics.log_metric(f"{name}_max_abs_diff", max_diff)
+        if max_diff > tolerance:
+            raise ValueError(
+                f"{name} export differs from the eager model by {max_diff} > {tolerance}"
+            )
+
+    exported_files = []
+    formats = [f.strip() for f in export_formats.split(",") if f.strip()]
+    example = batches[1]
+
+    if "torchscript" in formats:
+        with torch.no_grad():
+            traced = torch.jit.trace(
+                eager_model, (example["input_ids"], example["attention_mask"])
+            )
+        path = os.path.join(export_dir, "model.pt")
+        torch.jit.save(traced, path)
+        scripted = torch.jit.load(path)
+
+        def run_torchscript(b):
+            with torch.no_grad():
+                return scripted(b["input_ids"], b["attention_mask"])[0].numpy()
+
+        check("torchscript", run_torchscript)
+        exported_files.append("model.pt")
+
+    if "onnx" in formats:
+        import onnxruntime
+
+        path = os.path.join(export_dir, "model.onnx")
+        torch.onnx.export(
+            eager_model,
+            (example["input_ids"], example["attention_mask"]),
+            path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "logits": {0: "batch"},
+            },
+            opset_version=14,
+        )
+        session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+        def run_onnx(b):
+            return session.run(
+                None,
+                {
+                    "input_ids": b["input_ids"].numpy(),
+                    "attention_mask": b["attention_mask"].numpy(),
+                },
+            )[0]
+
+        check("onnx", run_onnx)
+        exported_files.append("model.onnx")
+
+    exported_model.metadata.update(model.metadata)
+    exported_model.metadata["artifact_files"] = list(artifact_files) + exported_files
+    exported_model.metadata["exported_files"] = exported_files
+    logging.info(f"Exported {exported_files} to {export_dir}")
+
+    outputs = namedtuple("Outputs", ["exported_files"])
+    return outputs(exported_files)
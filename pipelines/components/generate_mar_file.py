@@ -28,6 +28,7 @@ def generate_mar_file(
     """custom pipeline component to package model artifacts and custom
     handler to a model archive file using Torch Model Archiver tool
     """
+    import json
     import logging
     import os
     import subprocess
@@ -57,20 +58,66 @@ def generate_mar_file(
         else handler
     )
     model_artifacts_dir = f"{model_output_root}/model/{model_display_name}"
+    # only pack the files selected by get_training_job_details when the
+    # model artifact references the full training output
+    artifact_files = model.metadata.get("artifact_files") or os.listdir(model_artifacts_dir)
+
+    # serving settings (padding, bucketing, backend) shipped beside the handler
+    setup_config_path = os.path.join(os.path.dirname(handler_path), "setup_config.json")
+    setup_config = {}
+    if os.path.isfile(setup_config_path):
+        with open(setup_config_path) as f:
+            setup_config = json.load(f)
+
+    # the serialized file is the model of the serving backend: the traced
+    # model.pt or the model.onnx graph of export_model, or the eager weights,
+    # model.safetensors as saved by recent transformers or pytorch_model.bin.
+    # The models of the other backends are left out of the archive.
+    backend = setup_config.get("backend", "eager")
+    model_files = ["model.safetensors", "pytorch_model.bin", "model.pt", "model.onnx"]
+    if backend == "torchscript":
+        serialized_files = ["model.pt"]
+    elif backend == "onnxruntime":
+        serialized_files = ["model.onnx"]
+    else:
+        serialized_files = ["model.safetensors", "pytorch_model.bin"]
+    serialized_files = [f for f in serialized_files if f in artifact_files]
+    if not serialized_files:
+        raise ValueError(f"Missing the model of the {backend} backend in {model_artifacts_dir}")
+    serialized_file = serialized_files[0]
+    logging.info(f"Packing {serialized_file} for the {backend} backend")
     extra_files = [
         os.path.join(model_artifacts_dir, f)
-        for f in os.listdir(model_artifacts_dir)
-        if f != "pytorch_model.bin"
+        for f in artifact_files
+        if f not in model_files
     ]
+    # the handler loads the tokenizer from the MAR only, workers have no
+    # access to the Hugging Face hub
+    if "tokenizer.json" not in [os.path.basename(f) for f in extra_files]:
+        raise ValueError(f"Missing the fast tokenizer file tokenizer.json in {model_artifacts_dir}")
+    if os.path.isfile(setup_config_path):
+        extra_files.append(setup_config_path)
+
+    # serving profile applied by TorchServe: workers, batch size and delay
+    model_config_path = f"{mar_output_root}/model-config.yaml"
+    workers = setup_config.get("workers", 1)
+    with open(model_config_path, "w") as f:
+        f.write(
+            f"minWorkers: {workers}\n"
+            f"maxWorkers: {workers}\n"
+            f"batchSize: {setup_config.get('batch_size', 8)}\n"
+            f"maxBatchDelay: {setup_config.get('max_batch_delay', 10)}\n"
+        )
 
     # define model archive config
     mar_config = {
         "MODEL_NAME": model_display_name,
         "HANDLER": handler_path,
-        "SERIALIZED_FILE": f"{model_artifacts_dir}/pytorch_model.bin",
+        "SERIALIZED_FILE": f"{model_artifacts_dir}/{serialized_file}",
         "VERSION": model_version,
         "EXTRA_FILES": ",".join(extra_files),
         "EXPORT_PATH": f"{model_mar.path}/model-store",
+        "CONFIG_FILE": model_config_path,
     }
 
     # generate model archive command
@@ -85,6 +132,8 @@ def generate_mar_file(
         archiver_cmd += f" --export-path {mar_config['EXPORT_PATH']}"
     if "EXTRA_FILES" in mar_config:
         archiver_cmd += f" --extra-files {mar_config['EXTRA_FILES']}"
+    if "CONFIG_FILE" in mar_config:
+        archiver_cmd += f" --config-file {mar_config['CONFIG_FILE']}"
     if "REQUIREMENTS_FILE" in mar_config:
         archiver_cmd += f" --requirements-file {mar_config['REQUIREMENTS_FILE']}"
 
@@ -10,7 +10,7 @@ from google.protobuf.json_format import MessageToDict
 from google_cloud_pipeline_components import aiplatform as aip_components
 from google_cloud_pipeline_components.experimental import custom_job
 from kfp.v2 import compiler, dsl
-from kfp.v2.dsl import Input, Metrics, Model, Output, component
+from kfp.v2.dsl import ClassificationMetrics, Input, Metrics, Model, Output, component
 
 
 @component(
@@ -30,14 +30,34 @@ def get_training_job_details(
     eval_metric_key: str,
     model_display_name: str,
     metrics: Output[Metrics],
+    classification_metrics: Output[ClassificationMetrics],
     model: Output[Model],
+    artifact_files: str = (
+        "model.safetensors,pytorch_model.bin,config.json,all_results.json,"
+        "tokenizer.json,tokenizer_config.json,special_tokens_map.json,"
+        "sentencepiece.bpe.model,calibration.json,early_exit.pt"
+    ),
+    copy_mode: str = "copy",
+    max_workers: int = 16,
 ) -> NamedTuple(
     "Outputs", [("eval_metric", float), ("eval_loss", float), ("model_artifacts", str)]
 ):
     """custom pipeline component to get model artifacts and performance
     metrics from custom training job
+
+    Only the files of the model directory listed in `artifact_files`
+    (comma separated glob patterns) are taken, so checkpoints are left
+    behind. The weights are model.safetensors, as saved by recent
+    transformers, or pytorch_model.bin. `copy_mode` selects how they are
+    taken:
+      copy: parallel copies through the /gcs/ mount
+      reference: no copy, the model artifact points at the training output,
+                 the only mode that avoids the copy on GCS
     """
+    import concurrent.futures
+    import glob
     import logging
+    import os
     import shutil
     from collections import namedtuple
 
@@ -62,10 +82,32 @@ def get_training_job_details(
     job_base_dir = job_resource.job_spec.base_output_directory.output_uri_prefix
     logging.info(f"Custom job base output directory = {job_base_dir}")
 
-    # copy model artifacts
-    logging.info(f"Copying model artifacts to {model.path}")
-    destination = shutil.copytree(job_base_dir.replace("gs://", "/gcs/"), model.path)
-    logging.info(destination)
+    # copy model artifacts listed in the manifest
+    relative_model_dir = f"model/{model_display_name}"
+    source_dir = os.path.join(job_base_dir.replace("gs://", "/gcs/"), relative_model_dir)
+    sources = sorted({
+        path
+        for pattern in artifact_files.split(",")
+        for path in glob.glob(os.path.join(source_dir, pattern.strip()))
+        if os.path.isfile(path)
+    })
+    logging.info(f"Model artifacts selected: {[os.path.basename(f) for f in sources]}")
+
+    if copy_mode == "reference":
+        logging.info(f"Referencing model artifacts at {job_base_dir}")
+        model.uri = job_base_dir
+    else:
+        destination_dir = os.path.join(model.path, relative_model_dir)
+        os.makedirs(destination_dir, exist_ok=True)
+        logging.info(f"Copying model artifacts to {destination_dir}")
+
+        def copy_artifact(source):
+            destination = os.path.join(destination_dir, os.path.basename(source))
+            return shutil.copyfile(source, destination)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for destination in executor.map(copy_artifact, sources):
+                logging.info(destination)
     logging.info(f"Model artifacts located at {model.uri}/model/{model_display_name}")
     logging.info(f"Model artifacts located at model.uri = {model.uri}")
 
@@ -75,6 +117,7 @@ def get_training_job_details(
     model.metadata["framework"] = "pytorch"
     model.metadata["job_name"] = custom_job_name
     model.metadata["time_to_train_in_seconds"] = (end - start).total_seconds()
+    model.metadata["artifact_files"] = [os.path.basename(f) for f in sources]
 
     # fetch metrics from the training job run
     metrics_uri = f"{model.path}/model/{model_display_name}/all_results.json"
@@ -84,6 +127,20 @@ def get_training_job_details(
         logging.info(f"     {k} -> {v}")
         metrics.log_metric(k, v)
 
+    # rebuild the confusion matrix from its eval_confusion_matrix_<true>_<pred> cells
+    prefix = "eval_confusion_matrix_"
+    cells = {
+        tuple(int(i) for i in k[len(prefix):].split("_")): int(v)
+        for k, v in metrics_df.items()
+        if k.startswith(prefix)
+    }
+    if cells:
+        num_labels = max(max(cell) for cell in cells) + 1
+        classification_metrics.log_confusion_matrix(
+            [str(label) for label in range(num_labels)],
+            [[cells.get((t, p), 0) for p in range(num_labels)] for t in range(num_labels)],
+        )
+
     # capture eval metric and log to model metadata
     eval_metric = (
         metrics_df[eval_metric_key] if eval_metric_key in metrics_df.keys() else None
@@ -18,12 +18,32 @@ from kfp.v2.dsl import Input, Metrics, Model, Output, component
     packages_to_install=["google-cloud-aiplatform", "google-cloud-pipeline-components"],
     output_component_file="./pipelines/yaml/make_prediction_request.yaml",
 )
-def make_prediction_request(project: str, bucket: str, endpoint: str, instances: list):
+def make_prediction_request(
+    project: str,
+    bucket: str,
+    endpoint: str,
+    instances: list,
+    metrics: Output[Metrics],
+    batch_size: int = 8,
+    max_concurrency: int = 4,
+    endpoint_url: str = "",
+):
     """custom pipeline component to pass prediction requests to Vertex AI
     endpoint and get responses
+
+    Instances are sent in batches of `batch_size` with at most
+    `max_concurrency` requests in flight. Per-request latency percentiles and
+    throughput are logged as metrics. When `endpoint_url` is set, requests
+    are posted to that HTTP address (e.g. a local TorchServe) instead of the
+    Vertex AI endpoint.
     """
     import base64
+    import concurrent.futures
+    import json
     import logging
+    import math
+    import time
+    import urllib.request
 
     from google.cloud import aiplatform
     from google.protobuf.json_format import Parse
@@ -31,24 +51,82 @@ def make_prediction_request(project: str, bucket: str, endpoint: str, instances:
         GcpResources
 
     logging.getLogger().setLevel(logging.INFO)
-    aiplatform.init(project=project, staging_bucket=bucket)
 
-    # parse endpoint resource
-    logging.info(f"Endpoint = {endpoint}")
-    gcp_resources = Parse(endpoint, GcpResources())
-    endpoint_uri = gcp_resources.resources[0].resource_uri
-    endpoint_id = "/".join(endpoint_uri.split("/")[-8:-2])
-    logging.info(f"Endpoint ID = {endpoint_id}")
+    if endpoint_url:
+        logging.info(f"Endpoint URL = {endpoint_url}")
+
+        def predict(batch):
+            request = urllib.request.Request(
+                endpoint_url,
+                data=json.dumps({"instances": batch}).encode("utf-8"),
+                headers={"Content-Type": "application/json"},
+            )
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())["predictions"]
+    else:
+        aiplatform.init(project=project, staging_bucket=bucket)
+
+        # parse endpoint resource
+        logging.info(f"Endpoint = {endpoint}")
+        gcp_resources = Parse(endpoint, GcpResources())
+        endpoint_uri = gcp_resources.resources[0].resource_uri
+        endpoint_id = "/".join(endpoint_uri.split("/")[-8:-2])
+        logging.info(f"Endpoint ID = {endpoint_id}")
 
-    # define endpoint client
-    _endpoint = aiplatform.Endpoint(endpoint_id)
+        # define endpoint client
+        _endpoint = aiplatform.Endpoint(endpoint_id)
 
-    # call prediction endpoint for each instance
+        def predict(batch):
+            return _endpoint.predict(instances=batch).predictions
+
+    # encode instances
+    test_instances = []
     for instance in instances:
         if not isinstance(instance, (bytes, bytearray)):
             instance = instance.encode()
-        logging.info(f"Input text: {instance.decode('utf-8')}")
         b64_encoded = base64.b64encode(instance)
-        test_instance = [{"data": {"b64": f"{str(b64_encoded.decode('utf-8'))}"}}]
-        response = _endpoint.predict(instances=test_instance)
-        logging.info(f"Prediction response: {response.predictions}")
+        test_instances.append({"data": {"b64": f"{str(b64_encoded.decode('utf-8'))}"}})
+    batches = [
+        test_instances[i:i + batch_size] for i in range(0, len(test_instances), batch_size)
+    ]
+
+    def timed_predict(batch):
+        start = time.perf_counter()
+        predictions = predict(batch)
+        return time.perf_counter() - start, predictions
+
+    # call prediction endpoint for each batch of instances
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        results = list(executor.map(timed_predict, batches))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    for batch, (latency, predictions) in zip(batches, results):
+        for instance, prediction in zip(batch, predictions):
+            text = base64.b64decode(instance["data"]["b64"]).decode("utf-8")
+            logging.info(f"Input text: {text}")
+            logging.info(f"Prediction response: {prediction}")
+
+    def percentile(q):
+        # nearest-rank percentile
+        return latencies[max(0, math.ceil(q / 100 * len(latencies)) - 1)]
+
+    report = {
+        "requests": len(batches),
+        "instances": len(test_instances),
+    }
+    # latency and throughput are only defined when requests were sent
+    if latencies:
+        report.update({
+            "latency_p50_ms": percentile(50) * 1000,
+            "latency_p95_ms": percentile(95) * 1000,
+            "latency_p99_ms": percentile(99) * 1000,
+            "requests_per_second": len(batches) / elapsed,
+            "instances_per_second": len(test_instances) / elapsed,
+        })
+    else:
+        logging.warning("No instances to send, skipping the latency metrics")
+    for k, v in report.items():
+        logging.info(f"     {k} -> {v}")
+        metrics.log_metric(k, v)
@@ -0,0 +1,132 @@
+import os
+from typing import NamedTuple
+
+import google_cloud_pipeline_components
+import kfp
+from google.cloud import aiplatform
+from google.cloud.aiplatform import gapic as aip
+from google.cloud.aiplatform import pipeline_jobs
+from google.protobuf.json_format import MessageToDict
+from google_cloud_pipeline_components import aiplatform as aip_components
+from google_cloud_pipeline_components.experimental import custom_job
+from kfp.v2 import compiler, dsl
+from kfp.v2.dsl import Input, Metrics, Model, Output, component
+
+
+@component(
+    base_image="python:3.9",
+    packages_to_install=["google-cloud-aiplatform"],
+    output_component_file="./pipelines/yaml/run_hp_tuning.yaml",
+)
+def run_hp_tuning(
+    project: str,
+    location: str,
+    display_name: str,
+    is_hp_tuning_enabled: str,
+    worker_pool_specs: list,
+    hp_tuning_args: list,
+    study_spec_parameters: list,
+    base_output_directory: str,
+    metrics: Output[Metrics],
+    metric_id: str = "accuracy",
+    max_trial_count: int = 8,
+    parallel_trial_count: int = 4,
+    poll_seconds: int = 60,
+) -> NamedTuple("Outputs", [("worker_pool_specs", list)]):
+    """custom pipeline component to tune the hyperparameters of the training
+    job and return the worker pool specs of the final training job
+
+    When tuning is enabled, the trials of a Vertex AI hyperparameter tuning
+    job run `worker_pool_specs` with `hp_tuning_args` added to the training
+    arguments, and the returned specs train with the parameters of the best
+    trial. Otherwise `worker_pool_specs` are returned unchanged, so that the
+    training job always runs after this step.
+
+    `study_spec_parameters` are StudySpec.ParameterSpec dictionaries whose
+    parameter ids are training arguments, e.g. "learning-rate".
+    """
+    import copy
+    import logging
+    import time
+    from collections import namedtuple
+
+    from google.cloud.aiplatform import gapic as aip
+    from google.protobuf.json_format import ParseDict
+
+    logging.getLogger().setLevel(logging.INFO)
+    outputs = namedtuple("Outputs", ["worker_pool_specs"])
+
+    if is_hp_tuning_enabled != "y":
+        logging.info("Hyperparameter tuning disabled, training with the default parameters")
+        return outputs(worker_pool_specs)
+
+    def with_args(specs, args):
+        specs = copy.deepcopy(specs)
+        for spec in specs:
+            spec["container_spec"]["args"] = list(spec["container_spec"]["args"]) + args
+        return specs
+
+    # create the tuning job, every trial running the training job
+    job_spec = {
+        "display_name": display_name,
+        "study_spec": {
+            "metrics": [{"metric_id": metric_id, "goal": "MAXIMIZE"}],
+            "parameters": study_spec_parameters,
+        },
+        "max_trial_count": max_trial_count,
+        "parallel_trial_count": parallel_trial_count,
+        "trial_job_spec": {
+            "worker_pool_specs": with_args(worker_pool_specs, hp_tuning_args),
+            "base_output_directory": {"output_uri_prefix": base_output_directory},
+        },
+    }
+    hp_tuning_job = aip.HyperparameterTuningJob.wrap(
+        ParseDict(job_spec, aip.HyperparameterTuningJob.pb(aip.HyperparameterTuningJob()))
+    )
+    client_options = {"api_endpoint": f"{location}-aiplatform.googleapis.com"}
+    job_client = aip.JobServiceClient(client_options=client_options)
+    hp_tuning_job = job_client.create_hyperparameter_tuning_job(
+        parent=f"projects/{project}/locations/{location}",
+        hyperparameter_tuning_job=hp_tuning_job,
+    )
+    logging.info(f"Hyperparameter tuning job = {hp_tuning_job.name}")
+
+    # wait for the trials to finish
+    terminal_states = {
+        aip.JobState.JOB_STATE_SUCCEEDED,
+        aip.JobState.JOB_STATE_FAILED,
+        aip.JobState.JOB_STATE_CANCELLED,
+        aip.JobState.JOB_STATE_EXPIRED,
+    }
+    while hp_tuning_job.state not in terminal_states:
+        time.sleep(poll_seconds)
+        hp_tuning_job = job_client.get_hyperparameter_tuning_job(name=hp_tuning_job.name)
+    logging.info(f"Hyperparameter tuning job state = {hp_tuning_job.state.name}")
+
+    # pick the trial with the best final metric, trials stopped early
+    # report the metric they reached
+    measured = [
+        trial for trial in hp_tuning_job.trials
+        if trial.final_measurement and trial.final_measurement.metrics
+    ]
+    if not measured:
+        raise RuntimeError(f"No trial of {hp_tuning_job.name} reported {metric_id}")
+
+    def final_metric(trial):
+        return next(m.value for m in trial.final_measurement.metrics if m.metric_id == metric_id)
+
+    best = max(measured, key=final_metric)
+    best_args = []
+    for parameter in best.parameters:
+        value = parameter.value
+        # discrete values such as batch sizes come back as floats
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        best_args += [f"--{parameter.parameter_id}", str(value)]
+        metrics.log_metric(parameter.parameter_id, value)
+    metrics.log_metric(metric_id, final_metric(best))
+    metrics.log_metric("trials", len(hp_tuning_job.trials))
+    logging.info(f"Best trial {best.id}: {metric_id} = {final_metric(best)}, args = {best_args}")
+
+    # later arguments override the defaults of the training job
+    return outputs(with_args(worker_pool_specs, best_args))
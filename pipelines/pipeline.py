@@ -13,6 +13,8 @@ from kfp.v2 import compiler, dsl
 from kfp.v2.dsl import Input, Metrics, Model, Output, component
 from components.build_custom_train_image import build_custom_train_image
 from components.get_training_job_details import get_training_job_details
+from components.run_hp_tuning import run_hp_tuning
+from components.export_model import export_model
 from components.generate_mar_file import generate_mar_file
 from components.build_custom_serving_image import build_custom_serving_image
 from components.make_prediction_request import make_prediction_request
@@ -59,24 +61,81 @@ def pytorch_text_classifier_pipeline(
     training_args = [
         "--num-epochs", "2",
         "--model-name", cfg.MODEL_NAME,
-        "--batch-size", "128",
-        "--learning-rate", "5e-5"
+        "--batch-size", str(cfg.TRAIN_BATCH_SIZE),
+        "--gradient-accumulation-steps", str(cfg.GRADIENT_ACCUMULATION_STEPS),
+        "--mixed-precision", cfg.MIXED_PRECISION,
+        "--dataloader-num-workers", str(cfg.DATALOADER_NUM_WORKERS),
+        "--learning-rate", "5e-5",
+        "--dataset-cache-dir", cfg.DATASET_CACHE_DIR,
+        "--calibrate", "y",
     ]
     # define job name
     JOB_NAME = f"{cfg.MODEL_NAME}-train-pytorch-cstm-cntr-{TIMESTAMP}"
     GCS_BASE_OUTPUT_DIR = f"{cfg.GCS_STAGING}/{TIMESTAMP}"
-    # define worker pool specs
-    worker_pool_specs = [
-        {
-            "machine_spec": {
-                "machine_type": cfg.MACHINE_TYPE,
-                "accelerator_type": cfg.ACCELERATOR_TYPE,
-                "accelerator_count": cfg.ACCELERATOR_COUNT,
-            },
-            "replica_count": cfg.REPLICA_COUNT,
-            "container_spec": {"image_uri": cfg.TRAIN_IMAGE_URI, "args": training_args},
-        }
-    ]
+    # define worker pool specs: the chief in workerpool0 and any further
+    # replicas in workerpool1, all joining the same distributed job
+    training_args += ["--nproc-per-node", str(cfg.ACCELERATOR_COUNT)]
+    worker_pool_spec = {
+        "machine_spec": {
+            "machine_type": cfg.MACHINE_TYPE,
+            "accelerator_type": cfg.ACCELERATOR_TYPE,
+            "accelerator_count": cfg.ACCELERATOR_COUNT,
+        },
+        "replica_count": cfg.REPLICA_COUNT,
+        "container_spec": {"image_uri": cfg.TRAIN_IMAGE_URI, "args": training_args},
+    }
+    worker_pool_specs = [worker_pool_spec]
+    num_worker_replicas = int(cfg.NUM_WORKERS) - int(cfg.REPLICA_COUNT)
+    if num_worker_replicas > 0:
+        worker_pool_specs.append(
+            {**worker_pool_spec, "replica_count": str(num_worker_replicas)}
+        )
+
+    # ========================================================================
+    # hyperparameter tuning
+    # ========================================================================
+    # run parallel trials of the same training job when enabled, each one
+    # reporting its accuracy every HP_TUNING_REPORT_STEPS steps and stopping
+    # early when it falls behind the other trials. The training job then
+    # runs with the parameters of the best trial, or with the default ones
+    # when tuning is disabled.
+    hp_tuning_task = (
+        run_hp_tuning(
+            project=cfg.PROJECT_ID,
+            location=cfg.REGION,
+            display_name=f"{cfg.MODEL_NAME}-hptune-{TIMESTAMP}",
+            is_hp_tuning_enabled=is_hp_tuning_enabled,
+            worker_pool_specs=worker_pool_specs,
+            hp_tuning_args=[
+                "--hp-tune", "y",
+                "--hp-report-steps", str(cfg.HP_TUNING_REPORT_STEPS),
+                "--hp-pruner", cfg.HP_TUNING_PRUNER,
+                "--hp-trials-dir", f"{cfg.HP_TRIALS_DIR}/{TIMESTAMP}",
+            ],
+            study_spec_parameters=[
+                {
+                    "parameter_id": "learning-rate",
+                    "double_value_spec": {"min_value": 1e-5, "max_value": 1e-4},
+                    "scale_type": "UNIT_LOG_SCALE",
+                },
+                {
+                    "parameter_id": "batch-size",
+                    "discrete_value_spec": {"values": [32, 64, 128]},
+                    "scale_type": "UNIT_LINEAR_SCALE",
+                },
+                {
+                    "parameter_id": "weight-decay",
+                    "double_value_spec": {"min_value": 0.0, "max_value": 0.1},
+                    "scale_type": "UNIT_LINEAR_SCALE",
+                },
+            ],
+            base_output_directory=f"{GCS_BASE_OUTPUT_DIR}/hptune",
+            max_trial_count=cfg.HP_TUNING_MAX_TRIALS,
+            parallel_trial_count=cfg.HP_TUNING_PARALLEL_TRIALS,
+        )
+        .set_display_name("Run hyperparameter tuning job")
+        .after(build_custom_train_image_task)
+    )
 
     run_train_task = (
         custom_job.CustomTrainingJobOp(
@@ -84,10 +143,10 @@ def pytorch_text_classifier_pipeline(
             location=cfg.REGION,
             display_name=JOB_NAME,
             base_output_directory=GCS_BASE_OUTPUT_DIR,
-            worker_pool_specs=worker_pool_specs,
+            worker_pool_specs=hp_tuning_task.outputs["worker_pool_specs"],
         )
         .set_display_name("Run custom training job")
-        .after(build_custom_train_image_task)
+        .after(hp_tuning_task)
     )
 
     # ========================================================================
@@ -108,6 +167,15 @@ def pytorch_text_classifier_pipeline(
         training_job_details_task.outputs["eval_metric"] > eval_acc_threshold,
         name="model-deploy-decision",
     ):
+        # ===================================================================
+        # export TorchScript / ONNX graphs for the alternate backends
+        # ===================================================================
+        export_model_task = export_model(
+            model_display_name=cfg.MODEL_NAME,
+            model=training_job_details_task.outputs["model"],
+            export_formats=cfg.EXPORT_FORMATS,
+        ).set_display_name("Export TorchScript and ONNX models")
+
         # ===================================================================
         # create model archive file
         # ===================================================================
@@ -115,7 +183,7 @@ def pytorch_text_classifier_pipeline(
             model_display_name=cfg.MODEL_NAME,
             model_version=cfg.VERSION,
             handler=gs_serving_dependencies_path,
-            model=training_job_details_task.outputs["model"],
+            model=export_model_task.outputs["exported_model"],
         ).set_display_name("Create MAR file")
 
         # ===================================================================
@@ -192,6 +260,8 @@ def pytorch_text_classifier_pipeline(
             bucket=cfg.BUCKET,
             endpoint=model_deploy_task.outputs["gcp_resources"],
             instances=test_instances,
+            batch_size=cfg.PREDICTION_TEST_BATCH_SIZE,
+            max_concurrency=cfg.PREDICTION_TEST_MAX_CONCURRENCY,
         ).set_display_name("Test model deployment making online predictions")
         predict_test_instances_task
 
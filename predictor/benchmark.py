@@ -0,0 +1,510 @@
+"""Offline load generator and latency benchmark for the serving handler.
+
+Drives `TransformersClassifierHandler` in worker processes, the way
+TorchServe workers do, with a fake TorchServe context. Requests are replayed from
+JSONL files either at a fixed arrival rate (open loop) or by a fixed number
+of concurrent clients (closed loop), and grouped into batches with the same
+batch_size / max_batch_delay rules as TorchServe.
+
+Usage:
+    python predictor/benchmark.py --requests requests.jsonl --concurrency 8
+    python predictor/benchmark.py --requests requests.jsonl --rate 50 --duration 30
+    python predictor/benchmark.py --requests requests.jsonl --model-dir ./model \
+        --baseline-handler-config '{}' --handler-config '{"early_exit": true}'
+
+Without --model-dir a tiny randomly-initialised BERT is built in a temporary
+directory, which is enough to catch handler regressions on CPU.
+"""
+
+import argparse
+import base64
+import collections
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import queue
+import string
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from custom_handler import TransformersClassifierHandler  # noqa: E402
+
+STAGES = ("preprocess", "inference", "postprocess")
+
+
+class FakeContext(object):
+    """Minimal stand-in for the TorchServe context passed to
+    `handler.initialize`. The serialized file defaults to the weights file
+    found in `model_dir`.
+    """
+
+    def __init__(self, model_dir, serialized_file=None, handler_config=None):
+        serialized_file = serialized_file or find_serialized_file(model_dir)
+        self.manifest = {"model": {"serializedFile": serialized_file}}
+        self.system_properties = {"model_dir": model_dir, "gpu_id": 0}
+        self.model_yaml_config = {"handler": handler_config or {}}
+        self.metrics = None
+
+
+def find_serialized_file(model_dir):
+    """Returns the model file of a saved model, pytorch_model.bin or
+    model.safetensors as saved by newer transformers, or the model.pt or
+    model.onnx of export_model in a directory packed for those backends.
+    """
+    for name in ("pytorch_model.bin", "model.safetensors", "model.pt", "model.onnx"):
+        if os.path.isfile(os.path.join(model_dir, name)):
+            return name
+    raise FileNotFoundError(f"No model file in {model_dir}")
+
+
+def create_tiny_tokenizer():
+    """Builds a character level tokenizer with the special tokens of the
+    serving tokenizer, without downloading anything.
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers, processors
+    from transformers import XLMRobertaTokenizerFast
+
+    special_tokens = ["<s>", "<pad>", "</s>", "<unk>"]
+    characters = string.ascii_letters + string.digits + string.punctuation
+    vocab = [(token, 0.0) for token in special_tokens] + [(c, -1.0) for c in characters]
+    vocab.append(("<mask>", 0.0))
+    tokenizer = Tokenizer(models.Unigram(vocab, unk_id=special_tokens.index("<unk>")))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<s> $A </s>", pair="<s> $A </s> </s> $B </s>",
+        special_tokens=[("<s>", 0), ("</s>", 2)])
+    return XLMRobertaTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>",
+        pad_token="<pad>", cls_token="<s>", sep_token="</s>", mask_token="<mask>")
+
+
+def create_tiny_model(model_dir, num_labels=2, tokenizer_dir=None):
+    """Saves a tiny randomly-initialised BERT classifier into `model_dir`,
+    with the tokenizer saved in `tokenizer_dir`, or a character level
+    tokenizer built locally so that no download is needed.
+    """
+    from transformers import BertConfig, BertForSequenceClassification, XLMRobertaTokenizerFast
+
+    if tokenizer_dir:
+        tokenizer = XLMRobertaTokenizerFast.from_pretrained(tokenizer_dir, local_files_only=True)
+    else:
+        tokenizer = create_tiny_tokenizer()
+    config = BertConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        num_labels=num_labels,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    BertForSequenceClassification(config).save_pretrained(model_dir)
+    tokenizer.save_pretrained(model_dir)
+    return model_dir
+
+
+def read_requests(paths):
+    """Reads TorchServe request rows from JSONL files.
+
+    Each line is either a single instance or a Vertex AI style
+    `{"instances": [...]}` payload. An instance is a plain string or a dict
+    with a "data" (or "body") field holding a string or `{"b64": ...}`.
+    """
+    rows = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                payload = json.loads(line)
+                instances = payload["instances"] if isinstance(payload, dict) and "instances" in payload else [payload]
+                rows.extend(_to_row(instance) for instance in instances)
+    if not rows:
+        raise ValueError(f"No requests found in {paths}")
+    return rows
+
+
+def _to_row(instance):
+    if isinstance(instance, dict):
+        value = instance.get("data", instance.get("body"))
+        if isinstance(value, dict) and "b64" in value:
+            return {"data": base64.b64decode(value["b64"])}
+        if value is None:
+            # any other JSON object is scored on its serialized form
+            value = json.dumps(instance)
+        instance = value
+    return {"data": str(instance).encode("utf-8")}
+
+
+class Request(object):
+
+    def __init__(self, row, arrival):
+        self.row = row
+        self.arrival = arrival
+        self.done = threading.Event()
+        self.latency = None
+
+
+def serve(model_dir, handler_config, requests, results, batch_size, max_batch_delay,
+          warmup, warmup_rows):
+    """Body of a worker process, a single TorchServe worker: builds its own
+    handler and runs `warmup` batches of `warmup_rows`, then groups queued
+    requests into batches of at most `batch_size`, waiting at most
+    `max_batch_delay` seconds after the first one, and runs them through the
+    handler stage by stage.
+
+    Requests arrive as (id, row) pairs, and the worker puts
+    ("batch", ids, done, stage_times) on `results` for each batch. A None
+    request stops the worker, which then reports the exit layers of its
+    rows. perf_counter is a system-wide monotonic clock, so `done` compares
+    with the arrival times of the main process.
+    """
+    try:
+        handler = load_handler(model_dir, handler_config)
+        for i in range(warmup):
+            handler.postprocess(handler.inference(handler.preprocess(warmup_rows)))
+        handler.exit_layers.clear()
+    except Exception as e:
+        results.put(("error", repr(e)))
+        raise
+    results.put(("ready",))
+
+    stopping = False
+    while not stopping:
+        batch = [requests.get()]
+        deadline = time.perf_counter() + max_batch_delay
+        while len(batch) < batch_size and batch[-1] is not None:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        if batch[-1] is None:
+            stopping = True
+            batch.pop()
+        if batch:
+            results.put(_process(handler, batch))
+    results.put(("exit_layers", dict(handler.exit_layers)))
+
+
+def _process(handler, batch):
+    data = [row for _, row in batch]
+    start = time.perf_counter()
+    inputs = handler.preprocess(data)
+    preprocessed = time.perf_counter()
+    outputs = handler.inference(inputs)
+    inferred = time.perf_counter()
+    handler.postprocess(outputs)
+    done = time.perf_counter()
+
+    stage_times = {
+        "preprocess": preprocessed - start,
+        "inference": inferred - preprocessed,
+        "postprocess": done - inferred,
+    }
+    # finer stages recorded by the handler itself, in milliseconds
+    for stage, ms in handler.stage_times.items():
+        stage_times[f"handler_{stage}"] = ms / 1000
+    return ("batch", [request_id for request_id, _ in batch], done, stage_times)
+
+
+class WorkerPool(object):
+    """Worker processes of one model sharing the request queue, like the
+    TorchServe workers of a model. Each worker has its own interpreter,
+    handler and torch thread pool, so workers do not contend for the GIL.
+    """
+
+    def __init__(self, model_dir, handler_config, workers, batch_size, max_batch_delay,
+                 warmup=0, warmup_rows=None):
+        context = multiprocessing.get_context("spawn")
+        self.queue = context.Queue()
+        self.results = context.Queue()
+        self.workers = [
+            context.Process(
+                target=serve,
+                args=(model_dir, handler_config, self.queue, self.results,
+                      batch_size, max_batch_delay, warmup, warmup_rows),
+                daemon=True)
+            for _ in range(workers)
+        ]
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.batch_sizes = []
+        self.stage_times = {stage: [] for stage in STAGES}
+        self.exit_layers = collections.Counter()
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+
+    def start(self):
+        """Starts the workers and waits until all of them are warmed up."""
+        for worker in self.workers:
+            worker.start()
+        for worker in self.workers:
+            message = self._get()
+            if message[0] == "error":
+                raise RuntimeError(f"Benchmark worker failed to start: {message[1]}")
+        self.collector.start()
+
+    def stop(self):
+        """Stops the workers once the queued requests are answered, and
+        collects the exit layers of their rows.
+        """
+        for worker in self.workers:
+            self.queue.put(None)
+        self.collector.join()
+        for worker in self.workers:
+            worker.join()
+
+    def submit(self, request):
+        with self.lock:
+            request_id = next(self.ids)
+            self.pending[request_id] = request
+        self.queue.put((request_id, request.row))
+
+    def _get(self):
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("Benchmark worker exited unexpectedly")
+
+    def _collect(self):
+        stopped = 0
+        while stopped < len(self.workers):
+            message = self._get()
+            if message[0] == "exit_layers":
+                self.exit_layers.update(message[1])
+                stopped += 1
+                continue
+            _, request_ids, done, stage_times = message
+            for stage, seconds in stage_times.items():
+                self.stage_times.setdefault(stage, []).append(seconds)
+            self.batch_sizes.append(len(request_ids))
+            with self.lock:
+                requests = [self.pending.pop(request_id) for request_id in request_ids]
+            for request in requests:
+                request.latency = done - request.arrival
+                request.done.set()
+
+
+def run_closed_loop(pool, rows, concurrency, duration):
+    """Each of `concurrency` clients sends its next request as soon as the
+    previous one is answered.
+    """
+    completed = []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client(offset):
+        i = offset
+        while time.perf_counter() < stop_at:
+            request = Request(rows[i % len(rows)], time.perf_counter())
+            pool.submit(request)
+            request.done.wait()
+            with lock:
+                completed.append(request)
+            i += concurrency
+
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    return completed
+
+
+def run_fixed_rate(pool, rows, rate, duration):
+    """Requests arrive every 1 / `rate` seconds whether or not earlier ones
+    were answered. Latency counts from the scheduled arrival time.
+    """
+    requests = []
+    start = time.perf_counter()
+    for i in range(int(rate * duration)):
+        arrival = start + i / rate
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        request = Request(rows[i % len(rows)], arrival)
+        pool.submit(request)
+        requests.append(request)
+    for request in requests:
+        request.done.wait()
+    return requests
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of values."""
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def report(requests, pool, elapsed):
+    latencies = [request.latency for request in requests]
+    result = {
+        "requests": len(requests),
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(requests) / elapsed,
+        "mean_batch_size": sum(pool.batch_sizes) / len(pool.batch_sizes),
+    }
+    for q in (50, 90, 95, 99):
+        result[f"latency_p{q}_ms"] = percentile(latencies, q) * 1000
+    for stage, times in pool.stage_times.items():
+        result[f"{stage}_mean_ms"] = sum(times) / len(times) * 1000
+        result[f"{stage}_p95_ms"] = percentile(times, 95) * 1000
+
+    # distribution of the encoder layer at which rows left the model, when
+    # the handler serves with early exit
+    exit_layers = pool.exit_layers
+    if exit_layers:
+        rows = sum(exit_layers.values())
+        result["mean_exit_layer"] = sum(layer * count for layer, count in exit_layers.items()) / rows
+        for layer in sorted(exit_layers):
+            result[f"exit_layer_{layer}_fraction"] = exit_layers[layer] / rows
+    return result
+
+
+def get_args():
+    """Define the benchmark arguments with the default values.
+
+    Returns:
+        benchmark parameters
+    """
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument(
+        '--requests',
+        nargs='+',
+        required=True,
+        help='JSONL request files to replay.')
+    args_parser.add_argument(
+        '--model-dir',
+        default=None,
+        help='Unpacked model directory to serve. A tiny random BERT is used when not set.')
+    args_parser.add_argument(
+        '--tokenizer-dir',
+        default=None,
+        help='Local tokenizer directory of the tiny random BERT. A character level tokenizer is built when not set.')
+    args_parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=8,
+        help='Number of closed-loop clients. Ignored when --rate is set.')
+    args_parser.add_argument(
+        '--rate',
+        type=float,
+        default=None,
+        help='Fixed arrival rate in requests per second (open loop).')
+    args_parser.add_argument(
+        '--duration',
+        type=float,
+        default=10,
+        help='Duration of the run in seconds.')
+    args_parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=8,
+        help='TorchServe batch_size.')
+    args_parser.add_argument(
+        '--max-batch-delay',
+        type=float,
+        default=10,
+        help='TorchServe max_batch_delay in milliseconds.')
+    args_parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of handler workers sharing the request queue.')
+    args_parser.add_argument(
+        '--torch-threads',
+        type=int,
+        default=0,
+        help='torch intra-op threads, 0 keeps the setting of the handler config.')
+    args_parser.add_argument(
+        '--handler-config',
+        type=json.loads,
+        default={},
+        help='JSON object overriding the setup_config.json of the model, e.g. \'{"padding": "longest"}\'.')
+    args_parser.add_argument(
+        '--baseline-handler-config',
+        type=json.loads,
+        default=None,
+        help="""\
+        JSON object of a handler config to run first under the same load,
+        e.g. \'{}\' to compare --handler-config \'{"early_exit": true}\' with the
+        full model. Its results are reported with a baseline_ prefix, with
+        the throughput and latency speedups.\
+        """)
+    args_parser.add_argument(
+        '--warmup',
+        type=int,
+        default=3,
+        help='Number of batches run before measuring.')
+    args_parser.add_argument(
+        '--output',
+        default=None,
+        help='Optional path of a JSON file to write the report to.')
+    return args_parser.parse_args()
+
+
+def load_handler(model_dir, handler_config=None):
+    handler = TransformersClassifierHandler()
+    handler.initialize(FakeContext(model_dir, handler_config=handler_config))
+    return handler
+
+
+def run(args, rows, model_dir, handler_config):
+    """Serves the requests with handlers built with `handler_config` and
+    returns the benchmark report.
+    """
+    handler_config = dict(handler_config)
+    if args.torch_threads:
+        handler_config["torch_threads"] = args.torch_threads
+
+    pool = WorkerPool(model_dir, handler_config, args.workers, args.batch_size,
+                      args.max_batch_delay / 1000, args.warmup, rows[:args.batch_size])
+    pool.start()
+    start = time.perf_counter()
+    if args.rate:
+        requests = run_fixed_rate(pool, rows, args.rate, args.duration)
+    else:
+        requests = run_closed_loop(pool, rows, args.concurrency, args.duration)
+    elapsed = time.perf_counter() - start
+    pool.stop()
+    return report(requests, pool, elapsed)
+
+
+def main():
+    args = get_args()
+    rows = read_requests(args.requests)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_dir = args.model_dir or create_tiny_model(tmp_dir, tokenizer_dir=args.tokenizer_dir)
+        baseline = None
+        if args.baseline_handler_config is not None:
+            baseline = run(args, rows, model_dir, args.baseline_handler_config)
+        result = run(args, rows, model_dir, args.handler_config)
+
+    if baseline:
+        result.update({f"baseline_{k}": v for k, v in baseline.items()})
+        result["throughput_speedup"] = result["throughput_rps"] / baseline["throughput_rps"]
+        result["latency_p50_speedup"] = baseline["latency_p50_ms"] / result["latency_p50_ms"]
+        result["forward_speedup"] = (baseline["handler_forward_mean_ms"]
+                                     / result["handler_forward_mean_ms"])
+
+    for k, v in result.items():
+        print(f"{k:>24}: {v:.3f}" if isinstance(v, float) else f"{k:>24}: {v}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,122 @@
 
 import os
+import collections
+import hashlib
 import json
 import logging
+import random
+import time
+import unicodedata
 
 import torch
 from transformers import BertForSequenceClassification, XLMRobertaTokenizerFast
 from ts.torch_handler.base_handler import BaseHandler
 
+try:
+    from ts.metrics.metric_type_enum import MetricTypes
+except ImportError:
+    MetricTypes = None
+
 logger = logging.getLogger(__name__)
 
+# Default serving settings, overridden by the optional setup_config.json
+# packed into the MAR next to index_to_name.json
+#   padding: "max_length" pads every row to max_length, "longest" pads each
+#            batch to its longest row rounded up to pad_to_multiple_of
+#   bucket_size: when > 0, rows of similar length are grouped into forward
+#                passes of at most bucket_size rows
+#   quantization: "dynamic_int8" quantizes the linear layers to int8 at load
+#                 time on CPU, "none" serves the fp32 weights
+#   backend: "eager" runs the Hugging Face model, "torchscript" the traced
+#            model.pt and "onnxruntime" the model.onnx graph on CPU, both
+#            produced by the export_model pipeline step. generate_mar_file
+#            packs only the model of the backend, as the serialized file.
+#            quantization is ignored by the exported backends
+#   cache_size: when > 0, predictions of up to cache_size distinct texts are
+#               kept in an LRU cache for cache_ttl seconds
+#   top_k: when > 1, each response also lists the top_k labels and scores
+#   payload_log_rate: fraction of batches whose payload is logged at info
+#                     level, payloads are otherwise only logged at debug level
+#   sliding_window: when true, texts longer than max_length are split into
+#                   windows overlapping by window_stride tokens, scored in the
+#                   same forward passes, and their logits are aggregated per
+#                   request with window_aggregation ("max" or "mean")
+#   torch_threads, torch_interop_threads: size of the torch intra-op and
+#                   inter-op thread pools of each worker, 0 keeps the torch
+#                   defaults
+#   early_exit: when true, each row stops at the first early exit head whose
+#               top probability reaches early_exit_threshold, and only the
+#               rows left continue through the next encoder layers. Needs the
+#               heads trained with --early-exit-layers and packed in the MAR
+#               as early_exit.pt, and the eager backend. The calibration
+#               temperature only applies to the rows that reach the
+#               classifier of the model, the heads are not calibrated
+#   workers, batch_size, max_batch_delay: serving profile of the model,
+#                   written to the model-config.yaml of the MAR by
+#                   generate_mar_file and applied by TorchServe
+# A "handler" section of the TorchServe model config overrides these values.
+DEFAULT_SETUP_CONFIG = {
+    "max_length": 128,
+    "padding": "max_length",
+    "pad_to_multiple_of": 8,
+    "bucket_size": 0,
+    "quantization": "none",
+    "backend": "eager",
+    "cache_size": 0,
+    "cache_ttl": 600,
+    "top_k": 1,
+    "payload_log_rate": 0.0,
+    "sliding_window": False,
+    "window_stride": 32,
+    "window_aggregation": "max",
+    "torch_threads": 0,
+    "torch_interop_threads": 0,
+    "early_exit": False,
+    "early_exit_threshold": 0.9,
+    "workers": 1,
+    "batch_size": 8,
+    "max_batch_delay": 10,
+}
+
+
+class PredictionCache(object):
+    """
+    Bounded LRU cache of predictions with a time to live, keyed on a hash of
+    the normalised text and the model version.
+    """
+    def __init__(self, max_size, ttl, model_version):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.model_version = model_version
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, text):
+        normalized = unicodedata.normalize("NFKC", " ".join(text.split()))
+        return hashlib.sha256(f"{self.model_version}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl:
+            del self.entries[key]
+            self.evictions += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
 
 class TransformersClassifierHandler(BaseHandler):
     """
@@ -23,8 +131,13 @@ class TransformersClassifierHandler(BaseHandler):
         """ Loads the model.pt file and initialized the model object.
         Instantiates Tokenizer for preprocessor to use
         Loads labels to name mapping file for post-processing inference response
+
+        Everything is read from the model directory unpacked from the MAR,
+        so workers start without network access to the Hugging Face hub.
         """
         self.manifest = ctx.manifest
+        self.load_times = {}
+        start = time.perf_counter()
 
         properties = ctx.system_properties
         model_dir = properties.get("model_dir")
@@ -34,18 +147,80 @@ class TransformersClassifierHandler(BaseHandler):
         serialized_file = self.manifest["model"]["serializedFile"]
         model_pt_path = os.path.join(model_dir, serialized_file)
         if not os.path.isfile(model_pt_path):
-            raise RuntimeError("Missing the model.pt or pytorch_model.bin file")
+            raise RuntimeError(f"Missing the serialized file {serialized_file}")
+
+        # Read the serving settings
+        setup_config_path = os.path.join(model_dir, "setup_config.json")
+        self.setup_config = dict(DEFAULT_SETUP_CONFIG)
+        if os.path.isfile(setup_config_path):
+            with open(setup_config_path) as f:
+                self.setup_config.update(json.load(f))
+        model_yaml_config = getattr(ctx, "model_yaml_config", None) or {}
+        self.setup_config.update(model_yaml_config.get("handler") or {})
+        logger.info("Serving setup config: %s", self.setup_config)
+
+        # Size the torch thread pools so that the workers of a node do not
+        # oversubscribe its cores
+        if self.setup_config["torch_threads"] > 0:
+            torch.set_num_threads(self.setup_config["torch_threads"])
+        if self.setup_config["torch_interop_threads"] > 0:
+            try:
+                torch.set_num_interop_threads(self.setup_config["torch_interop_threads"])
+            except RuntimeError as e:
+                logger.warning("Could not set the inter-op threads: %s", e)
+        logger.info("Torch threads: %d intra-op, %d inter-op",
+                    torch.get_num_threads(), torch.get_num_interop_threads())
+        start = self._record_load_time("setup_config", start)
 
         # Load model
-        # self.model = AutoModelForSequenceClassification.from_pretrained(model_dir)
-        self.model = BertForSequenceClassification.from_pretrained(model_dir)
-        self.model.to(self.device)
-        self.model.eval()
-        logger.debug('Transformer model from path {0} loaded successfully'.format(model_dir))
+        # The MAR of the torchscript and onnxruntime backends packs their
+        # exported model as the serialized file, without the eager weights
+        self.backend = self.setup_config["backend"]
+        if self.backend != "eager" and self.setup_config["quantization"] != "none":
+            logger.warning("Quantization '%s' applies to the eager backend only, serving the %s model as exported",
+                           self.setup_config["quantization"], self.backend)
+        if self.backend == "torchscript":
+            self.model = torch.jit.load(self._backend_model_path(model_dir, serialized_file, "model.pt"),
+                                        map_location=self.device)
+            self.model.eval()
+        elif self.backend == "onnxruntime":
+            import onnxruntime
+            self.model = onnxruntime.InferenceSession(
+                self._backend_model_path(model_dir, serialized_file, "model.onnx"),
+                providers=["CPUExecutionProvider"])
+        elif self.backend == "eager":
+            # self.model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+            self.model = BertForSequenceClassification.from_pretrained(model_dir, local_files_only=True)
+            self.model.to(self.device)
+            self.model.eval()
 
-        # Ensure to use the same tokenizer used during training
+            if self.setup_config["quantization"] == "dynamic_int8":
+                start = self._record_load_time("model", start)
+                if self.device.type == "cpu":
+                    self.model = torch.quantization.quantize_dynamic(
+                        self.model, {torch.nn.Linear}, dtype=torch.qint8)
+                    logger.info("Linear layers quantized to dynamic int8")
+                else:
+                    logger.warning("Dynamic int8 quantization is CPU only, serving fp32 weights")
+        else:
+            raise RuntimeError(f"Unknown serving backend '{self.backend}'")
+        logger.debug('Transformer model from path {0} loaded successfully with the {1} backend'.format(
+            model_dir, self.backend))
+        stage = "quantization" if "model" in self.load_times else "model"
+        start = self._record_load_time(stage, start)
+
+        # Load the early exit heads trained with the model
+        self.early_exit_heads = None
+        self.exit_layers = collections.Counter()
+        if self.setup_config["early_exit"]:
+            self.early_exit_heads = self._load_early_exit_heads(model_dir)
+            start = self._record_load_time("early_exit", start)
+
+        # Ensure to use the same tokenizer used during training, saved with
+        # the model by the trainer and packed in the MAR as tokenizer.json
         # self.tokenizer = AutoTokenizer.from_pretrained('bert-base-cased')
-        self.tokenizer = XLMRobertaTokenizerFast.from_pretrained('microsoft/Multilingual-MiniLM-L12-H384')
+        self.tokenizer = XLMRobertaTokenizerFast.from_pretrained(model_dir, local_files_only=True)
+        start = self._record_load_time("tokenizer", start)
 
         # Read the mapping file, index to object name
         mapping_file_path = os.path.join(model_dir, "index_to_name.json")
@@ -57,39 +232,358 @@ class TransformersClassifierHandler(BaseHandler):
             logger.warning('Missing the index_to_name.json file. Inference output will default.')
             self.mapping = {"0": "Negative",  "1": "Positive"}
 
+        # Read the temperature fitted by the trainer on the classifier of the
+        # model to calibrate its scores
+        calibration_file_path = os.path.join(model_dir, "calibration.json")
+        self.temperature = 1.0
+        if os.path.isfile(calibration_file_path):
+            with open(calibration_file_path) as f:
+                self.temperature = json.load(f)["temperature"]
+        logger.info("Calibration temperature: %s", self.temperature)
+        self._record_load_time("mapping", start)
+
+        # Cache of predictions for repeated texts
+        self.cache = None
+        if self.setup_config["cache_size"] > 0:
+            model_version = "{0}:{1}".format(self.manifest["model"].get("modelName"),
+                                             self.manifest["model"].get("modelVersion"))
+            self.cache = PredictionCache(self.setup_config["cache_size"],
+                                         self.setup_config["cache_ttl"],
+                                         model_version)
+
+        logger.info("Worker load times (ms): %s, total %.1f",
+                    self.load_times, sum(self.load_times.values()))
         self.initialized = True
 
+    def _backend_model_path(self, model_dir, serialized_file, model_file):
+        """ Path of the exported model of the backend, the serialized file
+        when it is the exported model, as packed by generate_mar_file, or
+        `model_file` next to it.
+        """
+        if serialized_file == model_file:
+            return os.path.join(model_dir, serialized_file)
+        model_path = os.path.join(model_dir, model_file)
+        if not os.path.isfile(model_path):
+            raise RuntimeError(f"Missing the {model_file} file of the {self.backend} backend")
+        return model_path
+
+    def _load_early_exit_heads(self, model_dir):
+        """ Build the early exit heads saved by the trainer in early_exit.pt,
+        keyed by the encoder layer they follow, with the dense + tanh +
+        linear structure of trainer.model.create_early_exit_heads. Returns
+        None, and the full model is served, when early exit is unavailable.
+        """
+        heads_path = os.path.join(model_dir, "early_exit.pt")
+        if self.backend != "eager":
+            logger.warning("Early exit needs the eager backend, serving the full model")
+            return None
+        if not os.path.isfile(heads_path):
+            logger.warning("Missing the early_exit.pt file, serving the full model")
+            return None
+
+        checkpoint = torch.load(heads_path, map_location="cpu")
+        hidden_size = self.model.config.hidden_size
+        num_labels = self.model.config.num_labels
+        heads = torch.nn.ModuleDict({
+            str(layer): torch.nn.Sequential(
+                torch.nn.Linear(hidden_size, hidden_size),
+                torch.nn.Tanh(),
+                torch.nn.Linear(hidden_size, num_labels),
+            )
+            for layer in checkpoint["layers"]
+        })
+        heads.load_state_dict(checkpoint["state_dict"])
+        heads.to(self.device)
+        heads.eval()
+        if self.setup_config["quantization"] == "dynamic_int8" and self.device.type == "cpu":
+            heads = torch.quantization.quantize_dynamic(heads, {torch.nn.Linear}, dtype=torch.qint8)
+        logger.info("Early exit after layers %s at threshold %s",
+                    checkpoint["layers"], self.setup_config["early_exit_threshold"])
+        return heads
+
+    def _record_load_time(self, stage, start):
+        """ Record the time spent in one part of initialize in milliseconds
+        and return the start time of the next part.
+        """
+        now = time.perf_counter()
+        self.load_times[stage] = round((now - start) * 1000, 1)
+        return now
+
     def preprocess(self, data):
         """ Preprocessing input request by tokenizing
             Extend with your own preprocessing steps as needed
+
+            All the rows of the TorchServe batch are tokenized in a single
+            call to the fast tokenizer so that they share one forward pass.
+        """
+        self.stage_times = {}
+        start = time.perf_counter()
+        sentences = []
+        for row in data:
+            text = row.get("data")
+            if text is None:
+                text = row.get("body")
+            if isinstance(text, (bytes, bytearray)):
+                text = text.decode('utf-8')
+            sentences.append(text)
+        self.log_payload = (logger.isEnabledFor(logging.DEBUG)
+                            or random.random() < self.setup_config["payload_log_rate"])
+        if self.log_payload:
+            logger.info("Received %d texts: '%s'", len(sentences), sentences)
+        start = self._record_stage_time("decode", start)
+
+        # Serve repeated texts from the cache, only distinct misses reach
+        # the tokenizer and the model
+        keys, cached, duplicates = None, {}, {}
+        misses = list(range(len(sentences)))
+        if self.cache is not None:
+            hits, evictions = self.cache.hits, self.cache.evictions
+            keys = [self.cache.key(sentence) for sentence in sentences]
+            first_miss = {}
+            misses = []
+            for i, key in enumerate(keys):
+                if key in first_miss:
+                    duplicates[i] = first_miss[key]
+                    continue
+                prediction = self.cache.get(key)
+                if prediction is not None:
+                    cached[i] = prediction
+                else:
+                    first_miss[key] = i
+                    misses.append(i)
+            self._add_counter("PredictionCacheHits", self.cache.hits - hits + len(duplicates))
+            self._add_counter("PredictionCacheMisses", len(misses))
+            self._add_counter("PredictionCacheEvictions", self.cache.evictions - evictions)
+
+        buckets = []
+        if misses:
+            buckets = [([misses[i] for i in indices], bucket)
+                       for indices, bucket in self._tokenize([sentences[i] for i in misses])]
+        self._record_stage_time("tokenize", start)
+
+        self._add_metric("HandlerBatchSize", len(sentences), "count")
+        if buckets:
+            self._add_metric("HandlerBatchTokens",
+                             sum(int(bucket['attention_mask'].sum()) for _, bucket in buckets), "count")
+            self._add_metric("HandlerBatchPaddedTokens",
+                             sum(bucket['input_ids'].numel() for _, bucket in buckets), "count")
+        return {"size": len(sentences), "keys": keys, "cached": cached,
+                "duplicates": duplicates, "buckets": buckets}
+
+    def _tokenize(self, sentences):
+        """ Tokenize the texts into a list of (row indices, model inputs)
+        buckets. With sliding windows a row index appears once per window.
+        """
+        max_length = self.setup_config["max_length"]
+        window_args = {}
+        if self.setup_config["sliding_window"]:
+            window_args = {"return_overflowing_tokens": True,
+                           "stride": self.setup_config["window_stride"]}
+
+        if self.setup_config["padding"] == "max_length":
+            inputs = self.tokenizer(sentences,
+                                    padding='max_length',
+                                    max_length=max_length,
+                                    truncation=True,
+                                    return_tensors='pt',
+                                    **window_args)
+            if window_args:
+                return [(inputs.pop("overflow_to_sample_mapping").tolist(), inputs)]
+            return [(list(range(len(sentences))), inputs)]
+
+        encodings = self.tokenizer(sentences,
+                                   padding=False,
+                                   max_length=max_length,
+                                   truncation=True,
+                                   **window_args)
+        rows = encodings.get("overflow_to_sample_mapping") or list(range(len(sentences)))
+        return [([rows[i] for i in indices], self._pad(encodings, indices))
+                for indices in self._buckets(encodings)]
+
+    def _aggregate_windows(self, logits, indices):
+        """ Aggregate the logits of the windows of each request with max or
+        mean, and return them with the matching row indices.
+        """
+        rows, inverse = torch.unique(torch.tensor(indices, device=logits.device), return_inverse=True)
+        reduce = "amax" if self.setup_config["window_aggregation"] == "max" else "mean"
+        aggregated = torch.zeros(len(rows), logits.shape[-1], dtype=logits.dtype,
+                                 device=logits.device).scatter_reduce(
+            0, inverse.unsqueeze(-1).expand_as(logits), logits, reduce=reduce, include_self=False)
+        return aggregated, rows.tolist()
+
+    def _add_counter(self, name, value):
+        """ Export a custom TorchServe counter metric when the handler runs
+        inside TorchServe.
+        """
+        metrics = getattr(getattr(self, "context", None), "metrics", None)
+        if metrics is not None and value:
+            metrics.add_counter(name, value)
+
+    def _add_metric(self, name, value, unit):
+        """ Export a custom TorchServe histogram metric when the handler runs
+        inside TorchServe.
+        """
+        metrics = getattr(getattr(self, "context", None), "metrics", None)
+        if metrics is None:
+            return
+        if MetricTypes is not None:
+            metrics.add_metric(name, value, unit, metric_type=MetricTypes.HISTOGRAM)
+        else:
+            metrics.add_metric(name, value, unit)
+
+    def _record_stage_time(self, stage, start):
+        """ Record and export the time spent in one stage of the request in
+        milliseconds and return the start time of the next stage.
+        """
+        now = time.perf_counter()
+        self.stage_times[stage] = (now - start) * 1000
+        self._add_metric("Handler{0}Time".format(stage.capitalize()), self.stage_times[stage], "ms")
+        return now
+
+    def _buckets(self, encodings):
+        """ Group the row indices of a batch into buckets of similar token
+        length. Without bucketing the whole batch is a single bucket.
         """
-        text = data[0].get("data")
-        if text is None:
-            text = data[0].get("body")
-        sentences = text.decode('utf-8')
-        logger.info(f"Received data: '{data}'")
-        logger.info("Received text: '%s'", sentences)
-
-        # Tokenize the texts
-        tokenizer_args = ((sentences,))
-        inputs = self.tokenizer.encode_plus(*tokenizer_args,
-                                            padding='max_length',
-                                            max_length=128,
-                                            truncation=True,
-                                            return_tensors='pt')
-        return inputs
+        bucket_size = self.setup_config["bucket_size"]
+        indices = list(range(len(encodings["input_ids"])))
+        if bucket_size <= 0:
+            return [indices]
+
+        indices.sort(key=lambda i: len(encodings["input_ids"][i]))
+        return [indices[i:i + bucket_size] for i in range(0, len(indices), bucket_size)]
+
+    def _pad(self, encodings, indices):
+        """ Pad the rows of a bucket to its longest row, rounded up to
+        pad_to_multiple_of.
+        """
+        features = [{"input_ids": encodings["input_ids"][i],
+                     "attention_mask": encodings["attention_mask"][i]} for i in indices]
+        return self.tokenizer.pad(features,
+                                  padding='longest',
+                                  pad_to_multiple_of=self.setup_config["pad_to_multiple_of"] or None,
+                                  return_tensors='pt')
+
+    def _forward(self, input_ids, attention_mask):
+        """ Run one forward pass on the configured backend and return the
+        logits as a tensor, divided by the calibration temperature.
+        """
+        if self.early_exit_heads is not None:
+            return self._forward_early_exit(input_ids, attention_mask)
+
+        if self.backend == "onnxruntime":
+            logits = self.model.run(None, {"input_ids": input_ids.numpy(),
+                                           "attention_mask": attention_mask.numpy()})[0]
+            return torch.from_numpy(logits) / self.temperature
+
+        with torch.no_grad():
+            return self.model(input_ids.to(self.device), attention_mask.to(self.device))[0] / self.temperature
+
+    def _forward_early_exit(self, input_ids, attention_mask):
+        """ Run the encoder one layer at a time and return the logits of each
+        row from the first early exit head whose top probability reaches
+        early_exit_threshold, or from the classifier of the model when no
+        head is confident enough. Rows that exit are dropped from the batch
+        of the following layers.
+
+        The calibration temperature is fitted on the classifier of the model
+        only, so it divides the logits of the rows that reach the classifier
+        and the logits of the heads are returned uncalibrated.
+        """
+        bert = self.model.bert
+        layers = bert.encoder.layer
+        threshold = self.setup_config["early_exit_threshold"]
+        with torch.no_grad():
+            input_ids = input_ids.to(self.device)
+            hidden_states = bert.embeddings(input_ids=input_ids)
+            # additive mask of the padding tokens, as built by the model
+            mask = (1.0 - attention_mask.to(self.device, hidden_states.dtype)[:, None, None, :]) \
+                * torch.finfo(hidden_states.dtype).min
+
+            logits = torch.empty(len(input_ids), self.model.config.num_labels, device=self.device)
+            exit_layers = torch.full((len(input_ids),), len(layers), dtype=torch.long)
+            rows = torch.arange(len(input_ids), device=self.device)
+            for depth, layer in enumerate(layers, 1):
+                hidden_states = layer(hidden_states, mask)
+                if isinstance(hidden_states, tuple):
+                    hidden_states = hidden_states[0]
+                if str(depth) not in self.early_exit_heads:
+                    continue
+
+                head_logits = self.early_exit_heads[str(depth)](hidden_states[:, 0]).float()
+                confident = torch.softmax(head_logits, dim=-1).amax(dim=-1) >= threshold
+                if confident.any():
+                    logits[rows[confident]] = head_logits[confident]
+                    exit_layers[rows[confident].cpu()] = depth
+                    rows, hidden_states, mask = rows[~confident], hidden_states[~confident], mask[~confident]
+                if not len(rows):
+                    break
+
+            if len(rows):
+                logits[rows] = self.model.classifier(bert.pooler(hidden_states)).float() / self.temperature
+
+        self.exit_layers.update(exit_layers.tolist())
+        for depth, count in collections.Counter(exit_layers.tolist()).items():
+            self._add_counter("HandlerExitLayer{0}".format(depth), count)
+        self._add_metric("HandlerMeanExitLayer", exit_layers.float().mean().item(), "count")
+        return logits
 
     def inference(self, inputs):
-        """ Predict the class of a text using a trained transformer model.
+        """ Predict the class probabilities of every text in the batch using
+        a trained transformer model. Each bucket runs through its own forward
+        pass, the softmax is taken over the calibrated logits of the whole
+        batch at once, and one row of probabilities is returned per request,
+        in request order.
         """
-        logger.info(f"Model Inputs: '{inputs}'")
-        prediction = self.model(inputs['input_ids'].to(self.device))[0].argmax().item()
+        start = time.perf_counter()
+        probabilities = [None] * inputs["size"]
+        for i, row in inputs["cached"].items():
+            probabilities[i] = row
+
+        if inputs["buckets"]:
+            indices, logits = [], []
+            for bucket_indices, bucket in inputs["buckets"]:
+                if self.log_payload:
+                    logger.debug("Model Inputs: '%s'", bucket)
+                indices.extend(bucket_indices)
+                logits.append(self._forward(bucket['input_ids'], bucket['attention_mask']))
+            logits = torch.cat(logits).float()
+            if self.setup_config["sliding_window"]:
+                logits, indices = self._aggregate_windows(logits, indices)
+            rows = torch.softmax(logits, dim=-1).tolist()
+
+            evictions = self.cache.evictions if self.cache is not None else 0
+            for i, row in zip(indices, rows):
+                probabilities[i] = row
+                if self.cache is not None:
+                    self.cache.put(inputs["keys"][i], row)
+            if self.cache is not None:
+                self._add_counter("PredictionCacheEvictions", self.cache.evictions - evictions)
 
-        if self.mapping:
-            prediction = self.mapping[str(prediction)]
+        for i, first in inputs["duplicates"].items():
+            probabilities[i] = probabilities[first]
 
-        logger.info("Model predicted: '%s'", prediction)
-        return [prediction]
+        self._record_stage_time("forward", start)
+        return torch.tensor(probabilities)
 
     def postprocess(self, inference_output):
-        return inference_output
+        """ Turn the batch of probabilities into one response per request
+        with the predicted label, its score and, when top_k > 1, the top_k
+        labels and scores.
+        """
+        start = time.perf_counter()
+        top_k = min(self.setup_config["top_k"], inference_output.shape[-1])
+        scores, labels = inference_output.topk(top_k, dim=-1)
+
+        responses = []
+        for row_scores, row_labels in zip(scores.tolist(), labels.tolist()):
+            names = [self.mapping[str(label)] if self.mapping else label for label in row_labels]
+            response = {"label": names[0], "score": row_scores[0]}
+            if top_k > 1:
+                response["top_k"] = [{"label": name, "score": score}
+                                     for name, score in zip(names, row_scores)]
+            responses.append(response)
+
+        if self.log_payload:
+            logger.info("Model predicted: '%s'", responses)
+        self._record_stage_time("postprocess", start)
+        return responses
@@ -0,0 +1,154 @@
+"""Serving profile sweep for the serving handler.
+
+Runs `benchmark.py` over a grid of serving profiles (workers per model,
+torch threads per worker, batch size and max batch delay) and reports the
+profile with the best throughput whose p95 latency stays within the latency
+objective. Profiles using more threads than the machine has cores are
+skipped, so the sweep is specific to the machine it runs on, e.g. an
+n1-standard-4 serving node.
+
+Usage:
+    python predictor/sweep.py --requests requests.jsonl --model-dir ./model --latency-slo-ms 100
+
+The chosen profile can be copied into predictor/setup_config.json, from
+which generate_mar_file writes the TorchServe model config.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmark import create_tiny_model
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark.py")
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def get_args():
+    """Define the sweep arguments with the default values.
+
+    Returns:
+        sweep parameters
+    """
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument(
+        '--requests',
+        nargs='+',
+        required=True,
+        help='JSONL request files to replay.')
+    args_parser.add_argument(
+        '--model-dir',
+        default=None,
+        help='Unpacked model directory to serve. A tiny random BERT is used when not set.')
+    args_parser.add_argument(
+        '--tokenizer-dir',
+        default=None,
+        help='Local tokenizer directory of the tiny random BERT. A character level tokenizer is built when not set.')
+    args_parser.add_argument(
+        '--cpus',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of cores of the serving machine.')
+    args_parser.add_argument(
+        '--workers',
+        type=int_list,
+        default=[1, 2, 4],
+        help='Comma separated numbers of workers per model.')
+    args_parser.add_argument(
+        '--torch-threads',
+        type=int_list,
+        default=[1, 2, 4],
+        help='Comma separated numbers of torch threads per worker.')
+    args_parser.add_argument(
+        '--batch-sizes',
+        type=int_list,
+        default=[1, 8, 16],
+        help='Comma separated TorchServe batch sizes.')
+    args_parser.add_argument(
+        '--max-batch-delays',
+        type=int_list,
+        default=[5, 20],
+        help='Comma separated TorchServe max batch delays in milliseconds.')
+    args_parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=16,
+        help='Number of closed-loop clients of each run.')
+    args_parser.add_argument(
+        '--duration',
+        type=float,
+        default=10,
+        help='Duration of each run in seconds.')
+    args_parser.add_argument(
+        '--latency-slo-ms',
+        type=float,
+        default=100,
+        help='p95 latency objective in milliseconds.')
+    args_parser.add_argument(
+        '--output',
+        default=None,
+        help='Optional path of a JSON file to write all results to.')
+    return args_parser.parse_args()
+
+
+def run_profile(args, model_dir, profile, output):
+    """Benchmark one serving profile in a fresh process, so that its torch
+    thread settings do not leak into the next run.
+    """
+    command = [
+        sys.executable, BENCHMARK,
+        "--requests", *args.requests,
+        "--model-dir", model_dir,
+        "--concurrency", str(args.concurrency),
+        "--duration", str(args.duration),
+        "--workers", str(profile["workers"]),
+        "--torch-threads", str(profile["torch_threads"]),
+        "--batch-size", str(profile["batch_size"]),
+        "--max-batch-delay", str(profile["max_batch_delay"]),
+        "--output", output,
+    ]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    with open(output) as f:
+        return json.load(f)
+
+
+def main():
+    args = get_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_dir = args.model_dir or create_tiny_model(
+            os.path.join(tmp_dir, "model"), tokenizer_dir=args.tokenizer_dir)
+        results = []
+        for workers, threads, batch_size, delay in itertools.product(
+                args.workers, args.torch_threads, args.batch_sizes, args.max_batch_delays):
+            if workers * threads > args.cpus:
+                continue
+            profile = {"workers": workers, "torch_threads": threads,
+                       "batch_size": batch_size, "max_batch_delay": delay}
+            result = run_profile(args, model_dir, profile, os.path.join(tmp_dir, "result.json"))
+            results.append({"profile": profile, "result": result})
+            print(f"{profile} -> {result['throughput_rps']:.1f} rps, "
+                  f"p50 {result['latency_p50_ms']:.1f} ms, p95 {result['latency_p95_ms']:.1f} ms")
+
+    within_slo = [r for r in results if r["result"]["latency_p95_ms"] <= args.latency_slo_ms]
+    if within_slo:
+        best = max(within_slo, key=lambda r: r["result"]["throughput_rps"])
+        print(f"Best profile within a p95 of {args.latency_slo_ms} ms: {json.dumps(best['profile'])}")
+    else:
+        best = None
+        print(f"No profile meets a p95 of {args.latency_slo_ms} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"best": best, "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,18 +13,41 @@ MODEL_DISPLAY_NAME = f"{MODEL_NAME}-{VERSION}"
 PIPELINE_NAME = f"{APP_NAME}-pipeline"
 PIPELINE_ROOT = f"{BUCKET}/{APP_NAME}/pipelines"
 GCS_STAGING = f"{BUCKET}/{APP_NAME}/pipelines"
+DATASET_CACHE_DIR = f"{BUCKET}/{APP_NAME}/datasets/tokenized"
 
 # TRAIN_IMAGE_URI = f"gcr.io/{PROJECT_ID}/pytorch_gpu_train_{MODEL_NAME}"
 # SERVE_IMAGE_URI = f"gcr.io/{PROJECT_ID}/pytorch_cpu_predict_{MODEL_NAME}"
 TRAIN_IMAGE_URI = f"{REGION}-docker.pkg.dev/{PROJECT_ID}/{MODEL_NAME}-train-pytorch-gcp"
 SERVE_IMAGE_URI = f"{REGION}-docker.pkg.dev/{PROJECT_ID}/{MODEL_NAME}-torch-serve"
 
+# training nodes: REPLICA_COUNT chief replica in workerpool0 and
+# NUM_WORKERS - REPLICA_COUNT replicas in workerpool1, each training with one
+# process per accelerator
 MACHINE_TYPE = "n1-standard-16"
 REPLICA_COUNT = "1"
 ACCELERATOR_TYPE = "NVIDIA_TESLA_T4"
 ACCELERATOR_COUNT = "1"
 NUM_WORKERS = 1
 
+# training performance settings, the effective batch size is
+# TRAIN_BATCH_SIZE * GRADIENT_ACCUMULATION_STEPS per GPU
+TRAIN_BATCH_SIZE = 128
+GRADIENT_ACCUMULATION_STEPS = 1
+MIXED_PRECISION = "fp16"
+DATALOADER_NUM_WORKERS = 4
+
+# hyperparameter tuning job, trials share their metrics in HP_TRIALS_DIR so
+# that weak trials stop early
+HP_TUNING_MAX_TRIALS = 8
+HP_TUNING_PARALLEL_TRIALS = 4
+HP_TUNING_REPORT_STEPS = 100
+HP_TUNING_PRUNER = "median"
+HP_TRIALS_DIR = f"{BUCKET}/{APP_NAME}/hptune"
+
+# formats exported by export_model for the serving backends, the MAR packs
+# only the model of the backend set in predictor/setup_config.json
+EXPORT_FORMATS = "torchscript,onnx"
+
 SERVING_HEALTH_ROUTE = "/ping"
 SERVING_PREDICT_ROUTE = f"/predictions/{MODEL_NAME}"
 SERVING_CONTAINER_PORT= [{"containerPort": 7080}]
@@ -32,3 +55,5 @@ SERVING_MACHINE_TYPE = "n1-standard-4"
 SERVING_MIN_REPLICA_COUNT = 1
 SERVING_MAX_REPLICA_COUNT=1
 SERVING_TRAFFIC_SPLIT='{"0": 100}'
+PREDICTION_TEST_BATCH_SIZE = 8
+PREDICTION_TEST_MAX_CONCURRENCY = 4
@@ -0,0 +1,313 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the \"License\");
+# you may not use this file except in compliance with the License.\n",
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an \"AS IS\" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline batch scoring of parquet or JSONL files with a trained model.
+
+Rows are read in chunks. Each chunk is tokenized by a pool of threads while
+the model scores the previous chunks, sorted by length so that batches are
+padded to similar lengths, and written to its own parquet file with the
+predicted label and the class probabilities, in input order.
+
+Usage:
+    python -m trainer.batch_predict --model-dir gs://bucket/model/fbi-sms-pytorch \
+        --input gs://bucket/archive/*.parquet --output-dir gs://bucket/scores/20240101
+"""
+
+import argparse
+import base64
+import concurrent.futures
+import copy
+import glob
+import json
+import os
+import threading
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+from transformers import BertForSequenceClassification, XLMRobertaTokenizerFast
+
+from trainer import metadata, model, utils
+
+
+def get_args():
+    """Define the batch prediction arguments with the default values.
+
+    Returns:
+        batch prediction parameters
+    """
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument(
+        '--model-dir',
+        required=True,
+        help='Local or gs:// directory of the trained model and tokenizer.')
+    args_parser.add_argument(
+        '--input',
+        nargs='+',
+        required=True,
+        help="""\
+        Local or gs:// parquet or JSONL files, directories or glob patterns.
+        JSONL lines are single instances or {"instances": [...]} payloads,
+        as in the online prediction requests.\
+        """)
+    args_parser.add_argument(
+        '--output-dir',
+        required=True,
+        help='Local or gs:// directory of the scored parquet files.')
+    args_parser.add_argument(
+        '--text-column',
+        default='text',
+        help='Name of the text column of parquet input.')
+    args_parser.add_argument(
+        '--id-column',
+        default=None,
+        help='Optional column of parquet input copied to the output to identify rows.')
+    args_parser.add_argument(
+        '--batch-size',
+        help='Number of rows scored by each forward pass.',
+        type=int,
+        default=128)
+    args_parser.add_argument(
+        '--chunk-size',
+        help='Number of rows sorted by length together and written to each output file.',
+        type=int,
+        default=50000)
+    args_parser.add_argument(
+        '--tokenizer-workers',
+        help='Number of chunks tokenized concurrently with model execution.',
+        type=int,
+        default=2)
+    args_parser.add_argument(
+        '--torch-threads',
+        help='torch intra-op threads, 0 keeps the torch default.',
+        type=int,
+        default=0)
+    args_parser.add_argument(
+        '--max-length',
+        help='Maximum number of tokens per row.',
+        type=int,
+        default=metadata.MAX_SEQ_LENGTH)
+    args_parser.add_argument(
+        '--quantize',
+        default="n",
+        help='Score with the dynamic int8 quantized model. Valid values are: "y" - enable, "n" - disable')
+    return args_parser.parse_args()
+
+
+def input_files(patterns):
+    """Expands local or gs:// files, directories and glob patterns."""
+    files = []
+    for pattern in patterns:
+        path = utils.local_path(pattern)
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*.parquet")) +
+                                glob.glob(os.path.join(path, "*.jsonl"))))
+        else:
+            files.extend(sorted(glob.glob(path)))
+    if not files:
+        raise ValueError(f"No input files found in {patterns}")
+    return files
+
+
+def _instance_text(instance):
+    if isinstance(instance, dict):
+        value = instance.get("data", instance.get("body"))
+        if isinstance(value, dict) and "b64" in value:
+            return base64.b64decode(value["b64"]).decode("utf-8")
+        if value is None:
+            # any other JSON object is scored on its serialized form
+            return json.dumps(instance)
+        instance = value
+    return str(instance)
+
+
+def read_rows(files, text_column, id_column, batch_size):
+    """Streams (id, text) rows out of parquet and JSONL files. Rows without
+    an id column are identified by "<file>:<row number>".
+    """
+    for file in files:
+        if file.endswith(".parquet"):
+            columns = [text_column] + ([id_column] if id_column else [])
+            offset = 0
+            for batch in pq.ParquetFile(file).iter_batches(batch_size=batch_size, columns=columns):
+                batch = batch.to_pydict()
+                ids = batch[id_column] if id_column else range(offset, offset + len(batch[text_column]))
+                for row_id, text in zip(ids, batch[text_column]):
+                    yield str(row_id) if id_column else f"{file}:{row_id}", text or ""
+                offset += len(batch[text_column])
+        else:
+            with open(file) as f:
+                row = 0
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    payload = json.loads(line)
+                    instances = payload["instances"] if isinstance(payload, dict) and "instances" in payload else [payload]
+                    for instance in instances:
+                        yield f"{file}:{row}", _instance_text(instance)
+                        row += 1
+
+
+def read_chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+_local = threading.local()
+
+
+def _thread_tokenizer(tokenizer):
+    """Copy of the tokenizer owned by the calling thread, as a fast
+    tokenizer cannot change its truncation and padding settings while
+    another thread uses it.
+    """
+    if not hasattr(_local, "tokenizer"):
+        _local.tokenizer = copy.deepcopy(tokenizer)
+    return _local.tokenizer
+
+
+def tokenize_chunk(tokenizer, chunk, batch_size, max_length):
+    """Tokenizes a chunk of rows and groups them into batches of rows of
+    similar length, each padded to its own longest row.
+
+    Returns:
+      the padded batches, the chunk position of the rows of each batch and
+      the tokenization time in seconds
+    """
+    start = time.perf_counter()
+    tokenizer = _thread_tokenizer(tokenizer)
+    encoded = tokenizer([text for _, text in chunk], truncation=True, max_length=max_length)
+    order = sorted(range(len(chunk)), key=lambda i: len(encoded["input_ids"][i]))
+    batches = []
+    for i in range(0, len(order), batch_size):
+        positions = order[i:i + batch_size]
+        features = [{"input_ids": encoded["input_ids"][p], "attention_mask": encoded["attention_mask"][p]}
+                    for p in positions]
+        batches.append((positions, tokenizer.pad(features, pad_to_multiple_of=8, return_tensors="pt")))
+    return batches, time.perf_counter() - start
+
+
+def load_model(args):
+    """Loads the model, its tokenizer, label names and calibration
+    temperature from the model directory.
+    """
+    model_dir = utils.local_path(args.model_dir)
+    classifier = BertForSequenceClassification.from_pretrained(model_dir).eval()
+    if args.quantize == "y":
+        classifier = model.quantize(classifier)
+    if os.path.isfile(os.path.join(model_dir, "tokenizer.json")):
+        tokenizer = XLMRobertaTokenizerFast.from_pretrained(model_dir)
+    else:
+        tokenizer = utils.get_tokenizer()
+
+    labels = [classifier.config.id2label[i] for i in range(classifier.config.num_labels)]
+    index_to_name_path = os.path.join(model_dir, "index_to_name.json")
+    if os.path.isfile(index_to_name_path):
+        with open(index_to_name_path) as f:
+            index_to_name = json.load(f)
+        labels = [index_to_name.get(str(i), label) for i, label in enumerate(labels)]
+
+    temperature = 1.0
+    calibration_path = os.path.join(model_dir, "calibration.json")
+    if os.path.isfile(calibration_path):
+        with open(calibration_path) as f:
+            temperature = json.load(f)["temperature"]
+    return classifier, tokenizer, labels, temperature
+
+
+def score_chunk(args, classifier, labels, temperature, output_dir, chunk, future, report):
+    """Scores the tokenized batches of a chunk and writes them to the next
+    output file in input order.
+    """
+    batches, tokenize_seconds = future.result()
+    probabilities = [None] * len(chunk)
+
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for positions, inputs in batches:
+            logits = classifier(**inputs).logits
+            batch_probabilities = torch.softmax(logits.float() / temperature, dim=-1).tolist()
+            for position, row_probabilities in zip(positions, batch_probabilities):
+                probabilities[position] = row_probabilities
+            report["tokens"] += int(inputs["attention_mask"].sum())
+            report["padded_tokens"] += inputs["attention_mask"].numel()
+    model_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predictions = [max(range(len(p)), key=p.__getitem__) for p in probabilities]
+    table = pa.table({
+        "id": [row_id for row_id, _ in chunk],
+        "label": [labels[i] for i in predictions],
+        "score": pa.array([p[i] for p, i in zip(probabilities, predictions)], type=pa.float32()),
+        "probabilities": pa.array(probabilities, type=pa.list_(pa.float32())),
+    })
+    pq.write_table(table, os.path.join(output_dir, f"part-{report['files']:05d}.parquet"))
+
+    report["rows"] += len(chunk)
+    report["files"] += 1
+    report["tokenize_seconds"] += tokenize_seconds
+    report["model_seconds"] += model_seconds
+    report["write_seconds"] += time.perf_counter() - start
+    print(f"Scored {report['rows']} rows")
+
+
+def main():
+    args = get_args()
+    if args.torch_threads:
+        torch.set_num_threads(args.torch_threads)
+
+    classifier, tokenizer, labels, temperature = load_model(args)
+    output_dir = utils.local_path(args.output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    chunks = read_chunks(
+        read_rows(input_files(args.input), args.text_column, args.id_column, args.batch_size),
+        args.chunk_size)
+    report = {"rows": 0, "tokens": 0, "padded_tokens": 0, "files": 0,
+              "tokenize_seconds": 0.0, "model_seconds": 0.0, "write_seconds": 0.0}
+    start = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.tokenizer_workers) as executor:
+        # keep the tokenizer workers one chunk ahead of the model
+        pending = []
+        for chunk in chunks:
+            pending.append((chunk, executor.submit(
+                tokenize_chunk, tokenizer, chunk, args.batch_size, args.max_length)))
+            if len(pending) <= args.tokenizer_workers:
+                continue
+            score_chunk(args, classifier, labels, temperature, output_dir, *pending.pop(0), report)
+        for chunk, future in pending:
+            score_chunk(args, classifier, labels, temperature, output_dir, chunk, future, report)
+
+    elapsed = time.perf_counter() - start
+    report["elapsed_seconds"] = elapsed
+    report["rows_per_second"] = report["rows"] / elapsed
+    report["tokens_per_second"] = report["tokens"] / elapsed
+    report["padding_ratio"] = report["padded_tokens"] / max(report["tokens"], 1)
+    with open(os.path.join(output_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    for k, v in report.items():
+        print(f"{k:>18}: {v:.3f}" if isinstance(v, float) else f"{k:>18}: {v}")
+
+
+if __name__ == '__main__':
+    main()
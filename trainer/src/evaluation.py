@@ -0,0 +1,155 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the \"License\");
+# you may not use this file except in compliance with the License.\n",
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an \"AS IS\" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import torch
+
+from transformers import EvalPrediction
+
+
+class StreamingEvaluator(object):
+    """Classification metrics accumulated one evaluation batch at a time,
+    in memory that does not grow with the size of the evaluation set.
+
+    Used as `compute_metrics` of a Trainer with `batch_eval_metrics=True`:
+    the Trainer passes the logits and labels of each batch, and the metrics
+    are returned with the last batch. Keeps
+      - the confusion matrix, from which accuracy and the per-class
+        precision, recall and F1 score are derived
+      - per class histograms of the one-vs-rest log-odds of positive and
+        negative examples, from which the ROC-AUC is derived
+      - a uniform random sample of logits and labels, the examples with the
+        smallest random keys, used to fit the calibration temperature
+
+    Args:
+      num_labels: number of classes
+      num_bins: number of log-odds histogram bins of the ROC-AUC
+      max_log_odds: log-odds range of the histogram, beyond which scores
+        share the first or last bin
+      sample_size: number of examples kept in the calibration sample
+      seed: seed of the calibration sample
+    """
+
+    def __init__(self, num_labels, num_bins=4000, max_log_odds=20.0, sample_size=10000, seed=42):
+        self.num_labels = num_labels
+        self.num_bins = num_bins
+        self.max_log_odds = max_log_odds
+        self.sample_size = sample_size
+        self.rng = np.random.default_rng(seed)
+        self.sample_logits, self.sample_labels = None, None
+        self.reset()
+
+    def reset(self):
+        self.confusion = np.zeros((self.num_labels, self.num_labels), dtype=np.int64)
+        self.positives = np.zeros((self.num_labels, self.num_bins), dtype=np.int64)
+        self.negatives = np.zeros((self.num_labels, self.num_bins), dtype=np.int64)
+        self.seen = 0
+        self._keys = np.full(self.sample_size, np.inf)
+        self._logits = np.zeros((self.sample_size, self.num_labels), dtype=np.float32)
+        self._labels = np.zeros(self.sample_size, dtype=np.int64)
+
+    def update(self, logits, labels):
+        """Adds a batch of logits of shape (batch_size, num_labels) and
+        labels of shape (batch_size,).
+        """
+        logits = np.asarray(logits, dtype=np.float32)
+        labels = np.asarray(labels, dtype=np.int64)
+        # examples padded by the distributed gather carry the label -100
+        keep = labels >= 0
+        logits, labels = logits[keep], labels[keep]
+
+        preds = logits.argmax(axis=1)
+        np.add.at(self.confusion, (labels, preds), 1)
+
+        # one-vs-rest log-odds log(p / (1 - p)) of each class, computed from
+        # the logits to stay accurate for confident predictions
+        log_probs = logits - np.logaddexp.reduce(logits, axis=1, keepdims=True)
+        log_rest = np.log(-np.expm1(np.minimum(log_probs, -1e-7)))
+        log_odds = np.clip(log_probs - log_rest, -self.max_log_odds, self.max_log_odds)
+        bins = ((log_odds + self.max_log_odds) / (2 * self.max_log_odds) * (self.num_bins - 1)).astype(np.int64)
+        for c in range(self.num_labels):
+            is_positive = labels == c
+            self.positives[c] += np.bincount(bins[is_positive, c], minlength=self.num_bins)
+            self.negatives[c] += np.bincount(bins[~is_positive, c], minlength=self.num_bins)
+
+        # every example draws a uniform random key and the sample keeps the
+        # sample_size smallest keys seen so far, a uniform sample of the
+        # examples whatever their order
+        keys = np.concatenate([self._keys, self.rng.random(len(labels))])
+        keep = np.argpartition(keys, self.sample_size - 1)[:self.sample_size]
+        self._keys = keys[keep]
+        self._logits = np.concatenate([self._logits, logits])[keep]
+        self._labels = np.concatenate([self._labels, labels])[keep]
+        self.seen += len(labels)
+
+    def roc_auc(self, c):
+        """One-vs-rest ROC-AUC of class `c`, counting ties within a bin as
+        half ordered.
+        """
+        positives, negatives = self.positives[c], self.negatives[c]
+        num_positives, num_negatives = positives.sum(), negatives.sum()
+        if num_positives == 0 or num_negatives == 0:
+            return float("nan")
+        negatives_below = np.cumsum(negatives) - negatives
+        ordered = (positives * (negatives_below + 0.5 * negatives)).sum()
+        return float(ordered / (num_positives * num_negatives))
+
+    def compute(self):
+        """Returns the metrics of the examples added since the last reset,
+        as a flat dictionary of scalars.
+        """
+        confusion = self.confusion.astype(np.float64)
+        true_positives = np.diag(confusion)
+        predicted = confusion.sum(axis=0)
+        actual = confusion.sum(axis=1)
+        precision = np.divide(true_positives, predicted, out=np.zeros_like(true_positives), where=predicted > 0)
+        recall = np.divide(true_positives, actual, out=np.zeros_like(true_positives), where=actual > 0)
+        f1 = np.divide(2 * precision * recall, precision + recall,
+                       out=np.zeros_like(true_positives), where=precision + recall > 0)
+        roc_auc = [self.roc_auc(c) for c in range(self.num_labels)]
+
+        metrics = {
+            "accuracy": float(true_positives.sum() / max(confusion.sum(), 1)),
+            "macro_precision": float(precision.mean()),
+            "macro_recall": float(recall.mean()),
+            "macro_f1": float(f1.mean()),
+            # for two classes, the AUC of the positive class 1
+            "roc_auc": roc_auc[1] if self.num_labels == 2 else float(np.nanmean(roc_auc)),
+        }
+        for c in range(self.num_labels):
+            metrics[f"precision_{c}"] = float(precision[c])
+            metrics[f"recall_{c}"] = float(recall[c])
+            metrics[f"f1_{c}"] = float(f1[c])
+            metrics[f"roc_auc_{c}"] = roc_auc[c]
+            for p in range(self.num_labels):
+                metrics[f"confusion_matrix_{c}_{p}"] = int(self.confusion[c, p])
+        return metrics
+
+    def __call__(self, p: EvalPrediction, compute_result=False):
+        logits = p.predictions[0] if isinstance(p.predictions, tuple) else p.predictions
+        labels = p.label_ids
+        if isinstance(logits, torch.Tensor):
+            logits = logits.detach().float().cpu().numpy()
+        if isinstance(labels, torch.Tensor):
+            labels = labels.detach().cpu().numpy()
+        self.update(logits, labels)
+        if not compute_result:
+            return {}
+
+        metrics = self.compute()
+        # keep the calibration sample of the last complete evaluation
+        sampled = np.isfinite(self._keys)
+        self.sample_logits, self.sample_labels = self._logits[sampled], self._labels[sampled]
+        self.reset()
+        return metrics
@@ -12,27 +12,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import hashlib
+import json
 import os
+import time
+
 import numpy as np
 import hypertune
+import torch
+from torch.utils.data import DataLoader
 
 from transformers import (
-    AutoTokenizer,
-    EvalPrediction,
+    BertForSequenceClassification,
+    DataCollatorWithPadding,
     Trainer,
     TrainingArguments,
     default_data_collator,
     TrainerCallback,
-    XLMRobertaTokenizerFast,
 )
+from transformers.modeling_outputs import SequenceClassifierOutput
 
-from trainer import model, metadata, utils
+from trainer import evaluation, hptune, model, utils
 
 
 class HPTuneCallback(TrainerCallback):
     """
     A custom callback class that reports a metric to hypertuner
-    at the end of each epoch.
+    at each evaluation, every epoch or every `--hp-report-steps` steps.
     """
 
     def __init__(self, metric_tag, metric_value):
@@ -42,17 +49,210 @@ class HPTuneCallback(TrainerCallback):
         self.hpt = hypertune.HyperTune()
 
     def on_evaluate(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
         print(f"HP metric {self.metric_tag}={kwargs['metrics'][self.metric_value]}")
         self.hpt.report_hyperparameter_tuning_metric(
             hyperparameter_metric_tag=self.metric_tag,
             metric_value=kwargs['metrics'][self.metric_value],
-            global_step=state.epoch)
+            global_step=state.global_step)
+
+
+class PruningCallback(TrainerCallback):
+    """
+    A custom callback class that stops a tuning trial when its metric falls
+    behind the other trials, as decided by a `hptune.TrialPruner`.
+    """
+
+    def __init__(self, pruner, metric_value):
+        super(PruningCallback, self).__init__()
+        self.pruner = pruner
+        self.metric_value = metric_value
+        self.pruned = False
 
+    def on_evaluate(self, args, state, control, **kwargs):
+        # the first rank decides and every rank stops at the same step, the
+        # others would otherwise wait for it in the next gradient allreduce
+        prune = False
+        if state.is_world_process_zero:
+            prune = self.pruner.report(state.epoch, kwargs['metrics'][self.metric_value])
+        if utils.broadcast_from_main(prune):
+            if state.is_world_process_zero:
+                print(f"Pruning trial {self.pruner.trial_id} at epoch {state.epoch:.2f}")
+            self.pruned = True
+            control.should_training_stop = True
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if state.is_world_process_zero:
+            self.pruner.finish(self.pruned)
+
+
+class DistillationTrainer(Trainer):
+    """
+    A Trainer training a student on a mix of the cross-entropy with the
+    labels and the KL divergence from the teacher soft labels, read from
+    the `teacher_logits` column of the training dataset.
+    """
 
-def compute_metrics(p: EvalPrediction):
-    preds = p.predictions[0] if isinstance(p.predictions, tuple) else p.predictions
-    preds = np.argmax(preds, axis=1)
-    return {"accuracy": (preds == p.label_ids).astype(np.float32).mean().item()}
+    def __init__(self, *args, temperature=2.0, alpha=0.5, **kwargs):
+        super(DistillationTrainer, self).__init__(*args, **kwargs)
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def _set_signature_columns_if_needed(self):
+        super(DistillationTrainer, self)._set_signature_columns_if_needed()
+        # keep the soft labels that the model forward does not take
+        if "teacher_logits" not in self._signature_columns:
+            self._signature_columns.append("teacher_logits")
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        teacher_logits = inputs.pop("teacher_logits", None)
+        outputs = model(**inputs)
+        loss = outputs.loss
+        if teacher_logits is not None:
+            t = self.temperature
+            soft_loss = torch.nn.functional.kl_div(
+                torch.nn.functional.log_softmax(outputs.logits / t, dim=-1),
+                torch.nn.functional.log_softmax(teacher_logits.to(outputs.logits.dtype) / t, dim=-1),
+                reduction="batchmean",
+                log_target=True,
+            ) * t ** 2
+            loss = self.alpha * loss + (1 - self.alpha) * soft_loss
+        return (loss, outputs) if return_outputs else loss
+
+
+class EarlyExitTrainer(Trainer):
+    """
+    A Trainer training the early exit heads of the model together with the
+    model. The cross-entropy of each head on the [CLS] hidden state after
+    its encoder layer is averaged over the heads and added to the loss of
+    the model with the weight `loss_weight`.
+    """
+
+    def __init__(self, *args, loss_weight=1.0, **kwargs):
+        super(EarlyExitTrainer, self).__init__(*args, **kwargs)
+        self.loss_weight = loss_weight
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        outputs = model(**inputs, output_hidden_states=True)
+        loss = outputs.loss
+        if "labels" in inputs:
+            # the heads are reached through the distributed wrapper
+            unwrapped = getattr(model, "module", model)
+            heads = unwrapped.early_exit_heads
+            dropout = unwrapped.config.hidden_dropout_prob
+            head_losses = []
+            for layer, head in heads.items():
+                hidden_state = outputs.hidden_states[int(layer)][:, 0]
+                hidden_state = torch.nn.functional.dropout(hidden_state, dropout, training=model.training)
+                head_losses.append(torch.nn.functional.cross_entropy(
+                    head(hidden_state).float(), inputs["labels"]))
+            loss = loss + self.loss_weight * torch.stack(head_losses).mean()
+        # leave the hidden states out of the predictions gathered by the
+        # evaluation loop
+        outputs = SequenceClassifierOutput(loss=loss, logits=outputs.logits)
+        return (loss, outputs) if return_outputs else loss
+
+
+def fit_temperature(logits, labels, held_out_logits, held_out_labels):
+    """Fit the temperature that minimizes the negative log-likelihood of the
+    softmax of `logits / temperature` on calibration examples, and measure
+    the negative log-likelihood on disjoint held-out examples.
+
+    Args:
+      logits: array of shape (num_examples, num_labels)
+      labels: array of shape (num_examples,)
+      held_out_logits: array of shape (num_held_out, num_labels)
+      held_out_labels: array of shape (num_held_out,)
+
+    Returns:
+      the fitted temperature and the held-out negative log-likelihood
+      before and after calibration
+    """
+    logits = torch.as_tensor(logits, dtype=torch.float32)
+    labels = torch.as_tensor(labels, dtype=torch.long)
+    # optimize log(temperature) so that the temperature stays positive
+    log_temperature = torch.zeros(1, requires_grad=True)
+    optimizer = torch.optim.LBFGS([log_temperature], lr=0.1, max_iter=100)
+
+    def closure():
+        optimizer.zero_grad()
+        loss = torch.nn.functional.cross_entropy(logits / log_temperature.exp(), labels)
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    temperature = log_temperature.exp().item()
+    held_out_logits = torch.as_tensor(held_out_logits, dtype=torch.float32)
+    held_out_labels = torch.as_tensor(held_out_labels, dtype=torch.long)
+    with torch.no_grad():
+        nll_before = torch.nn.functional.cross_entropy(held_out_logits, held_out_labels).item()
+        nll_after = torch.nn.functional.cross_entropy(held_out_logits / temperature, held_out_labels).item()
+    return temperature, nll_before, nll_after
+
+
+def teacher_cache_key(args, dataset):
+    """Returns the content address of the teacher soft labels of a
+    tokenized dataset, which changes with the dataset or the teacher
+    weights.
+    """
+    teacher_dir = utils.local_path(args.teacher_dir)
+    weights = [f for f in ("model.safetensors", "pytorch_model.bin", "config.json")
+               if os.path.isfile(os.path.join(teacher_dir, f))][0]
+    key = {
+        "dataset": dataset._fingerprint,
+        "teacher": utils.file_md5(os.path.join(teacher_dir, weights)),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def add_teacher_logits(args, teacher, dataset, data_collator):
+    """Adds the logits of the teacher as the `teacher_logits` column of a
+    tokenized dataset.
+
+    The teacher runs once per dataset: when `args.dataset_cache_dir` is set,
+    the dataset with its soft labels is cached there and later jobs load it.
+
+    Args:
+      args: experiment parameters
+      teacher: fine-tuned teacher model
+      dataset: tokenized training dataset
+      data_collator: collator building the batches of the training loop
+    """
+    cache_path = None
+    if args.dataset_cache_dir:
+        cache_path = os.path.join(utils.local_path(args.dataset_cache_dir), "teacher",
+                                  teacher_cache_key(args, dataset))
+        cached = utils.load_cached_dataset(cache_path)
+        if cached is not None:
+            return cached
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    teacher = teacher.to(device).eval()
+    inputs = dataset.select_columns(
+        [c for c in ("input_ids", "attention_mask", "token_type_ids") if c in dataset.column_names])
+    dataloader = DataLoader(inputs, batch_size=args.batch_size, collate_fn=data_collator)
+    logits = []
+    with torch.inference_mode():
+        for batch in dataloader:
+            batch = {k: v.to(device) for k, v in batch.items()}
+            logits.extend(teacher(**batch).logits.float().cpu().tolist())
+    # free the accelerator for the student
+    teacher.to("cpu")
+    dataset = dataset.add_column("teacher_logits", logits)
+
+    if cache_path:
+        dataset = utils.save_cached_dataset(dataset, cache_path)
+    return dataset
+
+
+def data_collator_for(args, tokenizer):
+    """Returns the collator of the training batches."""
+    # with dynamic padding, batches group examples of similar length and
+    # are padded to their own longest example by the collator
+    if args.dynamic_padding == "y":
+        return DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8)
+    return default_data_collator
 
 
 def train(args, model, train_dataset, test_dataset):
@@ -64,49 +264,273 @@ def train(args, model, train_dataset, test_dataset):
       model: The neural network that you are training
       train_dataset: The training dataset
       test_dataset: The test dataset for evaluation
-    """
 
-    # initialize the tokenizer
+    Returns:
+      the trainer and the training runtime and throughput metrics
     """
-    tokenizer = AutoTokenizer.from_pretrained(
-        metadata.PRETRAINED_MODEL_NAME,
-        use_fast=True,
-    )
-    """
-    tokenizer = XLMRobertaTokenizerFast.from_pretrained(
-        metadata.PRETRAINED_MODEL_NAME,
-    )
+
+    # initialize the tokenizer, shared with the preprocessing stage
+    tokenizer = utils.get_tokenizer()
+
+    dynamic_padding = args.dynamic_padding == "y"
+    data_collator = data_collator_for(args, tokenizer)
+
+    # fp16 autocast needs CUDA, fall back to fp32 so that the same
+    # arguments still run on a CPU-only machine
+    mixed_precision = args.mixed_precision
+    if mixed_precision == "fp16" and not torch.cuda.is_available():
+        print("fp16 mixed precision needs a GPU, training in fp32")
+        mixed_precision = "no"
+
+    # tuning trials evaluate at step intervals so that they can stop early
+    report_steps = args.hp_report_steps if args.hp_tune == "y" else 0
 
     # set training arguments
     training_args = TrainingArguments(
-        evaluation_strategy="epoch",
+        eval_strategy="steps" if report_steps else "epoch",
+        eval_steps=report_steps or None,
+        batch_eval_metrics=True,
+        group_by_length=dynamic_padding,
+        length_column_name="length",
         learning_rate=args.learning_rate,
         per_device_train_batch_size=args.batch_size,
         per_device_eval_batch_size=args.batch_size,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        gradient_checkpointing=args.gradient_checkpointing == "y",
+        fp16=mixed_precision == "fp16",
+        bf16=mixed_precision == "bf16",
+        dataloader_num_workers=args.dataloader_num_workers,
+        dataloader_pin_memory=args.dataloader_pin_memory == "y",
+        ddp_backend=args.ddp_backend,
+        use_cpu=not torch.cuda.is_available(),
         num_train_epochs=args.num_epochs,
         weight_decay=args.weight_decay,
         output_dir=os.path.join("/tmp", args.model_name)
     )
 
-    # initialize our Trainer
-    trainer = Trainer(
+    # initialize our Trainer, distilling from the teacher soft labels when
+    # the training dataset carries them, or training the early exit heads
+    # when the model has them
+    trainer_kwargs = {}
+    trainer_class = Trainer
+    if "teacher_logits" in train_dataset.column_names:
+        trainer_class = DistillationTrainer
+        trainer_kwargs = {"temperature": args.distill_temperature, "alpha": args.distill_alpha}
+    elif hasattr(model, "early_exit_heads"):
+        trainer_class = EarlyExitTrainer
+        trainer_kwargs = {"loss_weight": args.early_exit_loss_weight}
+    trainer = trainer_class(
         model,
         training_args,
         train_dataset=train_dataset,
         eval_dataset=test_dataset,
-        data_collator=default_data_collator,
+        data_collator=data_collator,
         tokenizer=tokenizer,
-        compute_metrics=compute_metrics
+        compute_metrics=evaluation.StreamingEvaluator(model.config.num_labels),
+        **trainer_kwargs
     )
 
     # add hyperparameter tuning callback to report metrics when enabled
+    pruning = None
     if args.hp_tune == "y":
         trainer.add_callback(HPTuneCallback("accuracy", "eval_accuracy"))
+        if args.hp_pruner != "none" and args.hp_trials_dir:
+            pruner = hptune.TrialPruner(
+                args.hp_trials_dir, os.getenv("CLOUD_ML_TRIAL_ID", os.getpid()), args.hp_pruner)
+            pruning = PruningCallback(pruner, "eval_accuracy")
+            trainer.add_callback(pruning)
 
     # training
-    trainer.train()
+    train_output = trainer.train()
+
+    # training throughput, counting the non-padding tokens seen per epoch
+    train_metrics = dict(train_output.metrics)
+    train_metrics["train_tokens_per_second"] = (
+        utils.count_tokens(train_dataset) * args.num_epochs / train_metrics["train_runtime"])
+    train_metrics["train_effective_batch_size"] = (
+        args.batch_size * args.gradient_accumulation_steps * training_args.world_size)
+    if pruning:
+        train_metrics["train_pruned"] = pruning.pruned
+
+    return trainer, train_metrics
+
 
-    return trainer
+def final_eval_metrics(trainer):
+    """Returns the metrics of the final model. They are taken from the
+    evaluation run at the last training step when there is one, instead of
+    evaluating the same model again.
+
+    Args:
+      trainer: trainer after training
+    """
+    for log in reversed(trainer.state.log_history):
+        if "eval_loss" in log:
+            if log.get("step") == trainer.state.global_step:
+                return {k: v for k, v in log.items() if k.startswith("eval_")}
+            break
+    return trainer.evaluate()
+
+
+def eval_samples(args, test_dataset, num_samples):
+    """Returns a random subset of `num_samples` examples of the test set,
+    with only the model inputs and the label. The subset is drawn at random
+    because the test split can be sorted by label.
+    """
+    num_samples = min(len(test_dataset), num_samples)
+    samples = test_dataset.shuffle(seed=args.seed).select(range(num_samples))
+    return samples.remove_columns(
+        [c for c in samples.column_names if c not in ("input_ids", "attention_mask", "label")])
+
+
+def evaluate_quantized(args, trainer, test_dataset):
+    """Compare the dynamic int8 quantized model to the fp32 model on CPU on
+    a held-out subset of the test set.
+
+    Args:
+      args: experiment parameters
+      trainer: trainer holding the fine-tuned model
+      test_dataset: The test dataset for evaluation
+
+    Returns:
+      accuracy, agreement and speedup metrics of the quantized model
+    """
+    samples = eval_samples(args, test_dataset, args.quantization_eval_samples)
+    dataloader = DataLoader(samples, batch_size=args.batch_size, collate_fn=trainer.data_collator)
+
+    fp32_model = copy.deepcopy(trainer.model).to("cpu").eval()
+    int8_model = model.quantize(copy.deepcopy(fp32_model))
+
+    fp32_correct, int8_correct, agreement = 0, 0, 0
+    fp32_seconds, int8_seconds = 0.0, 0.0
+    with torch.no_grad():
+        for batch in dataloader:
+            labels = batch.pop("labels")
+            start = time.perf_counter()
+            fp32_preds = fp32_model(**batch).logits.argmax(dim=-1)
+            fp32_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            int8_preds = int8_model(**batch).logits.argmax(dim=-1)
+            int8_seconds += time.perf_counter() - start
+
+            fp32_correct += (fp32_preds == labels).sum().item()
+            int8_correct += (int8_preds == labels).sum().item()
+            agreement += (fp32_preds == int8_preds).sum().item()
+
+    num_samples = len(samples)
+    return {
+        "eval_int8_samples": num_samples,
+        "eval_int8_fp32_accuracy": fp32_correct / num_samples,
+        "eval_int8_accuracy": int8_correct / num_samples,
+        "eval_int8_agreement": agreement / num_samples,
+        "eval_int8_speedup": fp32_seconds / int8_seconds,
+    }
+
+
+def evaluate_latency(args, models, trainer, test_dataset):
+    """Measure the accuracy and the CPU latency of several models on the
+    same held-out subset of the test set, one batch at a time.
+
+    Args:
+      args: experiment parameters
+      models: dictionary of the models to compare by name
+      trainer: trainer holding the data collator
+      test_dataset: The test dataset for evaluation
+
+    Returns:
+      accuracy and latency per example of each model, prefixed with
+      eval_<name>_
+    """
+    samples = eval_samples(args, test_dataset, args.distill_eval_samples)
+    dataloader = DataLoader(samples, batch_size=args.batch_size, collate_fn=trainer.data_collator)
+
+    metrics = {}
+    for name, m in models.items():
+        m = copy.deepcopy(m).to("cpu").eval()
+        correct, seconds = 0, 0.0
+        with torch.no_grad():
+            for batch in dataloader:
+                labels = batch.pop("labels")
+                start = time.perf_counter()
+                preds = m(**batch).logits.argmax(dim=-1)
+                seconds += time.perf_counter() - start
+                correct += (preds == labels).sum().item()
+        metrics[f"eval_{name}_layers"] = m.config.num_hidden_layers
+        metrics[f"eval_{name}_accuracy"] = correct / len(samples)
+        metrics[f"eval_{name}_latency_ms"] = seconds / len(samples) * 1000
+    return metrics
+
+
+def evaluate_early_exit(args, trainer, test_dataset):
+    """Measure the early exit of the serving handler on CPU on a held-out
+    subset of the test set: each example exits at the first head whose top
+    probability reaches `args.early_exit_threshold`, or at the classifier of
+    the model after the last encoder layer.
+
+    Args:
+      args: experiment parameters
+      trainer: trainer holding the fine-tuned model and its early exit heads
+      test_dataset: The test dataset for evaluation
+
+    Returns:
+      accuracy of the early exit and of the full model, and the fraction of
+      the examples leaving at each layer
+    """
+    samples = eval_samples(args, test_dataset, args.early_exit_eval_samples)
+    dataloader = DataLoader(samples, batch_size=args.batch_size, collate_fn=trainer.data_collator)
+
+    m = copy.deepcopy(trainer.model).to("cpu").eval()
+    num_layers = m.config.num_hidden_layers
+    # latest head first, so that the earliest confident head decides
+    layers = sorted((int(layer) for layer in m.early_exit_heads), reverse=True)
+
+    correct, full_correct = 0, 0
+    exits = {layer: 0 for layer in sorted(layers) + [num_layers]}
+    with torch.no_grad():
+        for batch in dataloader:
+            labels = batch.pop("labels")
+            outputs = m(**batch, output_hidden_states=True)
+            full_preds = outputs.logits.argmax(dim=-1)
+            preds = full_preds.clone()
+            exit_layers = torch.full_like(labels, num_layers)
+            for layer in layers:
+                probs = torch.softmax(m.early_exit_heads[str(layer)](outputs.hidden_states[layer][:, 0]), dim=-1)
+                confident = probs.amax(dim=-1) >= args.early_exit_threshold
+                preds[confident] = probs.argmax(dim=-1)[confident]
+                exit_layers[confident] = layer
+
+            correct += (preds == labels).sum().item()
+            full_correct += (full_preds == labels).sum().item()
+            for layer in exit_layers.tolist():
+                exits[layer] += 1
+
+    num_samples = len(samples)
+    mean_layers = sum(layer * count for layer, count in exits.items()) / num_samples
+    metrics = {
+        "eval_early_exit_samples": num_samples,
+        "eval_early_exit_threshold": args.early_exit_threshold,
+        "eval_early_exit_accuracy": correct / num_samples,
+        "eval_early_exit_full_accuracy": full_correct / num_samples,
+        "eval_early_exit_mean_layers": mean_layers,
+        # the encoder layers dominate the cost of a forward pass
+        "eval_early_exit_estimated_speedup": num_layers / mean_layers,
+    }
+    for layer, count in exits.items():
+        metrics[f"eval_early_exit_layer_{layer}_fraction"] = count / num_samples
+    return metrics
+
+
+def save_early_exit_heads(trainer, model_dir):
+    """Detach the early exit heads from the model, so that the saved model
+    loads as a plain BertForSequenceClassification, and save them as
+    early_exit.pt for the serving handler.
+    """
+    heads = trainer.model.early_exit_heads
+    del trainer.model.early_exit_heads
+    os.makedirs(model_dir, exist_ok=True)
+    torch.save({
+        "layers": sorted(int(layer) for layer in heads),
+        "state_dict": heads.state_dict(),
+    }, os.path.join(model_dir, "early_exit.pt"))
 
 
 def run(args):
@@ -116,23 +540,96 @@ def run(args):
     Args:
       args: experiment parameters.
     """
-    # Open our dataset
-    train_dataset, test_dataset = utils.load_data(args)
+    # join the process group when started by the distributed launcher
+    utils.init_distributed(args.ddp_backend)
+
+    # Open our dataset, tokenized by the first rank and reused by the others
+    with utils.main_process_first():
+        train_dataset, test_dataset = utils.load_data(args)
 
     label_list = train_dataset.unique("label")
     num_labels = len(label_list)
 
     # Create the model, loss function, and optimizer
-    text_classifier = model.create(num_labels=num_labels)
+    teacher = None
+    if args.distill == "y":
+        if not args.teacher_dir:
+            raise ValueError("--distill y needs the fine-tuned model in --teacher-dir")
+        # a student with fewer layers learns from the soft labels of the
+        # fine-tuned teacher
+        teacher = BertForSequenceClassification.from_pretrained(utils.local_path(args.teacher_dir))
+        with utils.main_process_first():
+            train_dataset = add_teacher_logits(
+                args, teacher, train_dataset, data_collator_for(args, utils.get_tokenizer()))
+        text_classifier = model.create_student(num_labels, args.student_layers, teacher)
+    else:
+        text_classifier = model.create(num_labels=num_labels)
+
+    # classifier heads on intermediate layers, from which the serving
+    # handler lets confident examples exit before the last layer
+    early_exit_layers = [int(layer) for layer in args.early_exit_layers.split(",") if layer.strip()]
+    if early_exit_layers:
+        if teacher is not None:
+            raise ValueError("--early-exit-layers cannot be combined with --distill y")
+        text_classifier.early_exit_heads = model.create_early_exit_heads(
+            text_classifier, early_exit_layers)
 
     # Train / Test the model
-    trainer = train(args, text_classifier, train_dataset, test_dataset)
+    trainer, train_metrics = train(args, text_classifier, train_dataset, test_dataset)
+
+    # a pruned tuning trial only records how far it got, the pruning
+    # decision is shared by every rank
+    if train_metrics.get("train_pruned"):
+        trainer.save_metrics("all", train_metrics)
+        return
+
+    # metrics of the final model, with a sample of its logits for calibration
+    metrics = final_eval_metrics(trainer)
+    metrics.update(train_metrics)
+
+    # every rank took part in training and the gathered evaluation, only
+    # the first one reports and exports the model
+    if not trainer.is_world_process_zero():
+        return
+    if args.quantization_check == "y":
+        metrics.update(evaluate_quantized(args, trainer, test_dataset))
+    if teacher is not None:
+        latency = evaluate_latency(
+            args, {"teacher": teacher, "student": trainer.model}, trainer, test_dataset)
+        latency["eval_student_speedup"] = (
+            latency["eval_teacher_latency_ms"] / latency["eval_student_latency_ms"])
+        metrics.update(latency)
+    if early_exit_layers:
+        metrics.update(evaluate_early_exit(args, trainer, test_dataset))
 
-    metrics = trainer.evaluate(eval_dataset=test_dataset)
+    # fit the temperature used by the serving handler to calibrate scores
+    calibration = None
+    if args.calibrate == "y":
+        evaluator = trainer.compute_metrics
+        logits, labels = evaluator.sample_logits, evaluator.sample_labels
+        # fit on a random half of the evaluation sample and report the
+        # negative log-likelihood on the other half, out of sample
+        order = np.random.default_rng(args.seed).permutation(len(labels))
+        fit, held_out = np.array_split(order, 2)
+        temperature, nll_before, nll_after = fit_temperature(
+            logits[fit], labels[fit], logits[held_out], labels[held_out])
+        calibration = {"temperature": temperature}
+        metrics.update({
+            "eval_temperature": temperature,
+            "eval_calibration_samples": len(fit),
+            "eval_calibration_held_out_samples": len(held_out),
+            "eval_nll_uncalibrated": nll_before,
+            "eval_nll_calibrated": nll_after,
+        })
     trainer.save_metrics("all", metrics)
 
     # Export the trained model
+    if early_exit_layers:
+        save_early_exit_heads(trainer, os.path.join("/tmp", args.model_name))
     trainer.save_model(os.path.join("/tmp", args.model_name))
+    if calibration:
+        with open(os.path.join("/tmp", args.model_name, "calibration.json"), "w") as f:
+            json.dump(calibration, f)
 
     # Save the model to GCS
     if args.job_dir:
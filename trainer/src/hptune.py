@@ -0,0 +1,322 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the \"License\");
+# you may not use this file except in compliance with the License.\n",
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an \"AS IS\" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parallel hyperparameter tuning with early stopping of weak trials.
+
+Trials record the evaluation metric they report at step intervals in a
+shared trials directory, one JSON file per trial, and `TrialPruner` stops a
+trial whose metric falls behind the other trials at the same point of
+training. The directory can be local, for trials started by `main` on one
+machine, or a gs:// prefix shared by the trials of a Vertex AI
+hyperparameter tuning job.
+
+Usage:
+    python -m trainer.hptune --num-trials 8 --parallel-trials 2 -- --num-epochs 2
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import json
+import math
+import os
+import queue
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import torch
+
+from trainer import utils
+
+PRUNERS = ("none", "median", "halving")
+
+
+class TrialPruner(object):
+    """Decides whether a trial should stop early, comparing its metric with
+    the metrics of the other trials at the same training epoch. Epochs are
+    used rather than steps so that trials with different batch sizes are
+    compared after seeing the same number of examples. The metric is
+    maximized.
+
+    Args:
+      trials_dir: local or gs:// directory shared by the trials
+      trial_id: identifier of this trial
+      rule: "median" stops a trial below the median of the other trials,
+        "halving" keeps the top 1 / `reduction_factor` of the trials at
+        each rung of successive halving, "none" never stops a trial
+      min_epochs: fraction of an epoch trained before a trial can stop, and
+        first rung of successive halving
+      min_trials: number of other trials needed before comparing
+      reduction_factor: successive halving rate
+    """
+
+    def __init__(self, trials_dir, trial_id, rule="median", min_epochs=0.25,
+                 min_trials=3, reduction_factor=3):
+        if rule not in PRUNERS:
+            raise ValueError(f"Unknown pruner {rule}, valid values are {PRUNERS}")
+        self.trials_dir = utils.local_path(trials_dir)
+        self.trial_id = str(trial_id)
+        self.rule = rule
+        self.min_epochs = min_epochs
+        self.min_trials = min_trials
+        self.reduction_factor = reduction_factor
+        self.history = {}
+        os.makedirs(self.trials_dir, exist_ok=True)
+
+    @property
+    def path(self):
+        return os.path.join(self.trials_dir, f"trial-{self.trial_id}.json")
+
+    def _write(self, state, params=None):
+        record = {"trial": self.trial_id, "state": state, "history": self.history}
+        if params is not None:
+            record["params"] = params
+        # write next to the final location and rename, so that other trials
+        # never read a partially written record
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, self.path)
+
+    def _others(self):
+        others = []
+        for path in glob.glob(os.path.join(self.trials_dir, "trial-*.json")):
+            if path == self.path:
+                continue
+            try:
+                with open(path) as f:
+                    others.append({float(epoch): value for epoch, value
+                                   in json.load(f)["history"].items()})
+            except (OSError, ValueError):
+                # record being replaced by its trial
+                continue
+        return others
+
+    @staticmethod
+    def _value_at(history, epoch):
+        """Best metric of a trial up to `epoch`, or None if it has not
+        reported yet.
+        """
+        values = [value for e, value in history.items() if e <= epoch + 1e-6]
+        return max(values) if values else None
+
+    def report(self, epoch, value):
+        """Records the metric of this trial at `epoch`.
+
+        Returns:
+          True when the trial should stop
+        """
+        self.history[round(epoch, 4)] = value
+        self._write("running")
+        if self.rule == "none" or epoch < self.min_epochs:
+            return False
+
+        if self.rule == "median":
+            others = [self._value_at(h, epoch) for h in self._others()]
+            others = [v for v in others if v is not None]
+            if len(others) < self.min_trials:
+                return False
+            return self._value_at(self.history, epoch) < statistics.median(others)
+
+        # successive halving: only decide at the first report past a rung
+        rung = self.min_epochs * self.reduction_factor ** math.floor(
+            math.log(epoch / self.min_epochs, self.reduction_factor) + 1e-9)
+        previous = [e for e in self.history if e < round(epoch, 4)]
+        if previous and max(previous) >= rung:
+            return False
+        others = [self._value_at(h, rung) for h in self._others()
+                  if h and max(h) >= rung]
+        if len(others) < self.min_trials:
+            return False
+        value = self._value_at(self.history, epoch)
+        rank = sum(1 for v in others if v > value)
+        return rank >= math.ceil((len(others) + 1) / self.reduction_factor)
+
+    def finish(self, pruned, params=None):
+        """Marks the trial as pruned or completed."""
+        self._write("pruned" if pruned else "completed", params)
+
+
+def get_args():
+    """Define the tuning arguments with the default values. Arguments after
+    `--` are passed to every trial of trainer.task.
+
+    Returns:
+        tuning parameters and trial arguments
+    """
+    argv = sys.argv[1:]
+    trial_argv = []
+    if "--" in argv:
+        trial_argv = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument(
+        '--num-trials',
+        help='Total number of trials.',
+        type=int,
+        default=8)
+    args_parser.add_argument(
+        '--parallel-trials',
+        help='Number of trials running at the same time.',
+        type=int,
+        default=2)
+    args_parser.add_argument(
+        '--pruner',
+        default="median",
+        help='Early stopping rule. Valid values are: "median", "halving", "none"')
+    args_parser.add_argument(
+        '--report-steps',
+        help='Number of training steps between two evaluations of a trial.',
+        type=int,
+        default=100)
+    args_parser.add_argument(
+        '--trials-dir',
+        default=None,
+        help='Local or gs:// directory of the trial records, a temporary directory when not set.')
+    args_parser.add_argument(
+        '--learning-rate-range',
+        default="1e-5,1e-4",
+        help='Minimum and maximum learning rate, sampled on a log scale.')
+    args_parser.add_argument(
+        '--batch-sizes',
+        default="16,32,64",
+        help='Comma separated batch sizes to sample from.')
+    args_parser.add_argument(
+        '--weight-decay-range',
+        default="0.0,0.1",
+        help='Minimum and maximum weight decay.')
+    args_parser.add_argument(
+        '--seed',
+        help='Random seed of the search.',
+        type=int,
+        default=42)
+    return args_parser.parse_args(argv), trial_argv
+
+
+def sample_params(args, rng):
+    low, high = (float(v) for v in args.learning_rate_range.split(","))
+    decay_low, decay_high = (float(v) for v in args.weight_decay_range.split(","))
+    return {
+        "learning-rate": math.exp(rng.uniform(math.log(low), math.log(high))),
+        "batch-size": rng.choice([int(v) for v in args.batch_sizes.split(",")]),
+        "weight-decay": rng.uniform(decay_low, decay_high),
+    }
+
+
+def run_trial(trial_id, params, model_name, trial_argv, trials_dir, slots):
+    """Runs one trial of trainer.task in its own process on a free slot,
+    i.e. a GPU or a share of the CPU cores.
+    """
+    slot = slots.get()
+    try:
+        env = dict(os.environ, CLOUD_ML_TRIAL_ID=str(trial_id), **slot)
+        command = [sys.executable, "-m", "trainer.task", *trial_argv,
+                   "--model-name", f"{model_name}-trial-{trial_id}",
+                   "--hp-trials-dir", trials_dir,
+                   "--nproc-per-node", "1",
+                   "--job-dir", ""]
+        for name, value in params.items():
+            command += [f"--{name}", str(value)]
+        start = time.perf_counter()
+        result = subprocess.run(command, env=env)
+        return result.returncode, time.perf_counter() - start
+    finally:
+        slots.put(slot)
+
+
+def main():
+    # imported here, trainer.task imports the experiment using TrialPruner
+    from trainer import task
+
+    args, trial_argv = get_args()
+    trials_dir = args.trials_dir or os.path.join("/tmp", f"hptune-{int(time.time())}")
+    trial_args = task.get_args(trial_argv)
+
+    # tokenize the dataset once, every trial loads the cached shards
+    if not trial_args.dataset_cache_dir:
+        trial_args.dataset_cache_dir = os.path.join(trials_dir, "datasets")
+    utils.load_data(trial_args)
+    trial_argv = [*trial_argv,
+                  "--dataset-cache-dir", trial_args.dataset_cache_dir,
+                  "--hp-tune", "y",
+                  "--hp-pruner", args.pruner,
+                  "--hp-report-steps", str(args.report_steps)]
+
+    # one GPU per trial, or an equal share of the CPU cores
+    slots = queue.Queue()
+    num_gpus = torch.cuda.device_count()
+    threads = max(os.cpu_count() // args.parallel_trials, 1)
+    for i in range(args.parallel_trials):
+        if num_gpus:
+            slots.put({"CUDA_VISIBLE_DEVICES": str(i % num_gpus)})
+        else:
+            slots.put({"CUDA_VISIBLE_DEVICES": "", "OMP_NUM_THREADS": str(threads)})
+
+    rng = random.Random(args.seed)
+    trials = {i: sample_params(args, rng) for i in range(args.num_trials)}
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel_trials) as executor:
+        futures = {i: executor.submit(run_trial, i, params, trial_args.model_name,
+                                      trial_argv, trials_dir, slots)
+                   for i, params in trials.items()}
+        outcomes = {i: future.result() for i, future in futures.items()}
+    elapsed = time.perf_counter() - start
+
+    # collect the trial records and the final metrics of completed trials
+    results = []
+    for i, params in trials.items():
+        returncode, seconds = outcomes[i]
+        record_path = os.path.join(utils.local_path(trials_dir), f"trial-{i}.json")
+        record = {}
+        if os.path.isfile(record_path):
+            with open(record_path) as f:
+                record = json.load(f)
+        history = record.get("history", {})
+        results.append({
+            "trial": i,
+            "params": params,
+            "state": record.get("state", "failed") if returncode == 0 else "failed",
+            "epochs": max((float(e) for e in history), default=0.0),
+            "best_metric": max(history.values(), default=None),
+            "seconds": seconds,
+        })
+
+    finished = [r for r in results if r["best_metric"] is not None]
+    best = max(finished, key=lambda r: r["best_metric"]) if finished else None
+    budget = args.num_trials * trial_args.num_epochs
+    summary = {
+        "best": best,
+        "trials": results,
+        "elapsed_seconds": elapsed,
+        "trial_seconds": sum(r["seconds"] for r in results),
+        "epochs_trained": sum(r["epochs"] for r in results),
+        "epochs_budget": budget,
+    }
+    with open(os.path.join(utils.local_path(trials_dir), "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+
+    for r in sorted(results, key=lambda r: -(r["best_metric"] or 0)):
+        print(f"trial {r['trial']:>3} {r['state']:>9} epochs {r['epochs']:.2f} "
+              f"accuracy {r['best_metric']} {json.dumps(r['params'])}")
+    print(f"Trained {summary['epochs_trained']:.2f} of {budget} epochs in {elapsed:.0f}s")
+    if best:
+        print(f"Best trial {best['trial']}: {json.dumps(best['params'])}")
+
+
+if __name__ == '__main__':
+    main()
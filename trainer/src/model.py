@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import torch
 from transformers import BertForSequenceClassification
 from trainer import metadata
 
@@ -30,3 +31,72 @@ def create(num_labels):
 
     return model
 
+
+def create_student(num_labels, num_layers, teacher=None):
+    """create a student model for distillation, with the architecture of
+    the pretrained model but only `num_layers` encoder layers
+
+    The student starts from the embeddings and evenly spaced encoder layers
+    of the teacher, or of the pretrained model when no teacher is given.
+
+    Args:
+      num_labels: number of target labels
+      num_layers: number of encoder layers of the student
+      teacher: fine-tuned teacher model
+    """
+    student = BertForSequenceClassification.from_pretrained(
+        metadata.PRETRAINED_MODEL_NAME,
+        num_labels=num_labels,
+        num_hidden_layers=num_layers,
+    )
+    if teacher is not None:
+        teacher_layers = teacher.bert.encoder.layer
+        step = len(teacher_layers) / num_layers
+        student.bert.embeddings.load_state_dict(teacher.bert.embeddings.state_dict())
+        for i, layer in enumerate(student.bert.encoder.layer):
+            layer.load_state_dict(teacher_layers[int((i + 1) * step) - 1].state_dict())
+        student.bert.pooler.load_state_dict(teacher.bert.pooler.state_dict())
+        student.classifier.load_state_dict(teacher.classifier.state_dict())
+
+    return student
+
+
+def create_early_exit_heads(model, layers):
+    """create the classifier heads of early exit, one per encoder layer in
+    `layers`. Each head classifies the [CLS] hidden state after its layer,
+    with the same dense + tanh + linear structure as the pooler and
+    classifier of the model. The serving handler builds the same heads.
+
+    Args:
+      model: model whose intermediate layers get a head
+      layers: encoder layers, counted from 1, e.g. [3, 6, 9]
+    """
+    num_layers = model.config.num_hidden_layers
+    if not layers or any(layer < 1 or layer >= num_layers for layer in layers):
+        raise ValueError(f"Early exit layers {layers} must be between 1 and {num_layers - 1}")
+    hidden_size = model.config.hidden_size
+    heads = torch.nn.ModuleDict({
+        str(layer): torch.nn.Sequential(
+            torch.nn.Linear(hidden_size, hidden_size),
+            torch.nn.Tanh(),
+            torch.nn.Linear(hidden_size, model.config.num_labels),
+        )
+        for layer in sorted(layers)
+    })
+    # start the dense layer of each head from the pretrained pooler
+    for head in heads.values():
+        head[0].load_state_dict(model.bert.pooler.dense.state_dict())
+    return heads
+
+
+def quantize(model):
+    """apply dynamic int8 quantization to the linear layers of a model, the
+    same way the serving handler does when quantization is enabled. The
+    quantized model runs on CPU only.
+
+    Args:
+      model: fp32 model on CPU
+    """
+    return torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
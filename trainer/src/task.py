@@ -14,13 +14,20 @@
 
 import argparse
 import os
+import sys
 
-from trainer import experiment
+import torch
+from torch.distributed import run as distributed_run
 
+from trainer import experiment, utils
 
-def get_args():
+
+def get_args(argv=None):
     """Define the task arguments with the default values.
 
+    Args:
+        argv: arguments to parse, the command line arguments when not set
+
     Returns:
         experiment parameters
     """
@@ -50,6 +57,57 @@ def get_args():
         default=42,
     )
 
+    # Preprocessing arguments
+    args_parser.add_argument(
+        '--preprocess-batch-size',
+        help='Number of examples per batch passed to the tokenizer in dataset.map.',
+        type=int,
+        default=1000)
+    args_parser.add_argument(
+        '--preprocess-num-proc',
+        help='Number of processes used by dataset.map to tokenize the dataset.',
+        type=int,
+        default=None)
+    args_parser.add_argument(
+        '--dataset-path',
+        default=None,
+        help="""\
+        Local or gs:// parquet file, or directory of parquet files, to train on.
+        When not set, the dataset metadata.DATASET_NAME is loaded from the
+        Hugging Face hub.\
+        """)
+    args_parser.add_argument(
+        '--text-column',
+        default='text',
+        help='Name of the text column of the parquet dataset.')
+    args_parser.add_argument(
+        '--label-column',
+        default='label',
+        help='Name of the label column of the parquet dataset.')
+    args_parser.add_argument(
+        '--test-size',
+        help='Fraction of the parquet dataset assigned to the test split by text hash.',
+        type=float,
+        default=0.2)
+    args_parser.add_argument(
+        '--dataset-cache-dir',
+        default=os.getenv('DATASET_CACHE_DIR'),
+        help="""\
+        Local directory or gs:// prefix where the tokenized dataset is cached.
+        Jobs with the same dataset, tokenizer, sequence length and labels
+        reuse the cached shards instead of tokenizing again.\
+        """)
+
+    args_parser.add_argument(
+        '--dynamic-padding',
+        default="n",
+        help="""\
+        Store unpadded token ids, group examples of similar length into the
+        same batch and pad each batch to its own longest example.
+        Valid values are: "y" - enable, "n" - pad every example to
+        metadata.MAX_SEQ_LENGTH\
+        """)
+
     # Estimator arguments
     args_parser.add_argument(
         '--learning-rate',
@@ -73,29 +131,217 @@ def get_args():
         default=0.01,
         type=float)
 
+    # Performance arguments
+    args_parser.add_argument(
+        '--mixed-precision',
+        default="no",
+        help="""\
+        Train with autocast mixed precision. Valid values are: "fp16" (CUDA
+        only, e.g. T4), "bf16" (Ampere GPUs or CPU), "no" - full fp32\
+        """)
+    args_parser.add_argument(
+        '--gradient-accumulation-steps',
+        help="""\
+        Number of steps whose gradients are accumulated before each optimizer
+        update. The effective batch size is batch-size * steps.\
+        """,
+        type=int,
+        default=1)
+    args_parser.add_argument(
+        '--gradient-checkpointing',
+        default="n",
+        help="""\
+        Recompute encoder activations in the backward pass to fit larger
+        batches in GPU memory. Valid values are: "y" - enable, "n" - disable\
+        """)
+    args_parser.add_argument(
+        '--dataloader-num-workers',
+        help='Number of processes loading training batches, 0 loads them in the main process.',
+        type=int,
+        default=0)
+    args_parser.add_argument(
+        '--dataloader-pin-memory',
+        default="y",
+        help='Pin dataloader memory for faster host to GPU copies. Valid values are: "y" - enable, "n" - disable')
+
+    # Distributed training arguments
+    args_parser.add_argument(
+        '--nproc-per-node',
+        help="""\
+        Number of training processes started on each node. Defaults to the
+        number of GPUs, or 1 on CPU. Together with the replicas listed in
+        CLUSTER_SPEC, more than one process trains with DistributedDataParallel.\
+        """,
+        type=int,
+        default=None)
+    args_parser.add_argument(
+        '--ddp-backend',
+        default=None,
+        help='torch distributed backend. Defaults to "nccl" on GPUs and "gloo" on CPU.')
+
     # Enable hyperparameter
     args_parser.add_argument(
         '--hp-tune',
         default="n",
         help='Enable hyperparameter tuning. Valida values are: "y" - enable, "n" - disable')
+    args_parser.add_argument(
+        '--hp-report-steps',
+        help="""\
+        Evaluate and report the tuning metric every this many training steps,
+        so that weak trials can stop early. 0 reports once per epoch.\
+        """,
+        type=int,
+        default=0)
+    args_parser.add_argument(
+        '--hp-pruner',
+        default="none",
+        help="""\
+        Early stopping rule of tuning trials. Valid values are: "median" -
+        stop below the median of the other trials, "halving" - successive
+        halving, "none" - never stop early\
+        """)
+    args_parser.add_argument(
+        '--hp-trials-dir',
+        default=os.getenv('HP_TRIALS_DIR'),
+        help='Local or gs:// directory where tuning trials share their metrics with the pruner.')
+
+    # Distillation arguments
+    args_parser.add_argument(
+        '--distill',
+        default="n",
+        help="""\
+        Train a student with --student-layers encoder layers on the soft
+        labels of the fine-tuned model in --teacher-dir, and compare their
+        accuracy and CPU latency. Valid values are: "y" - enable, "n" - disable\
+        """)
+    args_parser.add_argument(
+        '--teacher-dir',
+        default=None,
+        help='Local or gs:// directory of the fine-tuned teacher model.')
+    args_parser.add_argument(
+        '--student-layers',
+        help='Number of encoder layers of the student.',
+        type=int,
+        default=4)
+    args_parser.add_argument(
+        '--distill-temperature',
+        help='Softmax temperature of the teacher and student soft labels.',
+        type=float,
+        default=2.0)
+    args_parser.add_argument(
+        '--distill-alpha',
+        help='Weight of the hard label loss, the soft label loss gets 1 - alpha.',
+        type=float,
+        default=0.5)
+    args_parser.add_argument(
+        '--distill-eval-samples',
+        help='Number of test examples used to compare the student and teacher latency.',
+        type=int,
+        default=2000)
+
+    # Early exit arguments
+    args_parser.add_argument(
+        '--early-exit-layers',
+        default="",
+        help="""\
+        Comma separated encoder layers, e.g. "3,6,9", that get a classifier
+        head trained with the model. The heads are saved as early_exit.pt
+        next to the model, for the early exit mode of the serving handler.
+        Empty to disable\
+        """)
+    args_parser.add_argument(
+        '--early-exit-loss-weight',
+        help='Weight of the mean loss of the early exit heads, added to the loss of the model.',
+        type=float,
+        default=1.0)
+    args_parser.add_argument(
+        '--early-exit-threshold',
+        help='Confidence above which an example exits at a head, in the evaluation of the heads.',
+        type=float,
+        default=0.9)
+    args_parser.add_argument(
+        '--early-exit-eval-samples',
+        help='Number of test examples used to measure the exit layers and the latency.',
+        type=int,
+        default=2000)
+
+    # Calibration arguments
+    args_parser.add_argument(
+        '--calibrate',
+        default="n",
+        help="""\
+        Fit a softmax temperature on half of a sample of the test set,
+        report the negative log-likelihood before and after calibration on
+        the other half, and save the temperature as calibration.json next to
+        the model for the serving handler.
+        Valid values are: "y" - enable, "n" - disable\
+        """)
+
+    # Quantization arguments
+    args_parser.add_argument(
+        '--quantization-check',
+        default="n",
+        help="""\
+        Compare the dynamic int8 quantized model used by the CPU serving
+        image to the fp32 model on the test set and add the results to
+        all_results.json. Valid values are: "y" - enable, "n" - disable\
+        """)
+    args_parser.add_argument(
+        '--quantization-eval-samples',
+        help='Number of test examples used by the quantization check.',
+        type=int,
+        default=2000)
 
     # Saved model arguments
     args_parser.add_argument(
         '--job-dir',
         default=os.getenv('AIP_MODEL_DIR'),
         help='GCS location to export models')
+    args_parser.add_argument(
+        '--upload-workers',
+        help='Number of files of the saved model uploaded concurrently.',
+        type=int,
+        default=8)
     args_parser.add_argument(
         '--model-name',
         default="fbi-sms-pytorch",
         help='The name of your saved model')
 
-    return args_parser.parse_args()
+    return args_parser.parse_args(argv)
+
+
+def launch(args):
+    """Restarts the task under the torch distributed launcher with one
+    process per GPU on each node of the job, when there is more than one
+    process in total.
+
+    Returns:
+      True when the job ran under the launcher
+    """
+    nproc_per_node = args.nproc_per_node or max(torch.cuda.device_count(), 1)
+    node_rank, num_nodes, master_addr, master_port = utils.cluster_spec()
+    if num_nodes * nproc_per_node == 1:
+        return False
+    distributed_run.main([
+        "--nnodes", str(num_nodes),
+        "--node-rank", str(node_rank),
+        "--nproc-per-node", str(nproc_per_node),
+        "--master-addr", master_addr,
+        "--master-port", str(master_port),
+        "-m", "trainer.task",
+        *sys.argv[1:],
+    ])
+    return True
 
 
 def main():
     """Setup / Start the experiment
     """
     args = get_args()
+    # ranks started by the launcher run the experiment, the first process
+    # of each node starts them
+    if not utils.is_distributed() and launch(args):
+        return
     print(args)
     experiment.run(args)
 
@@ -13,34 +13,130 @@
 # limitations under the License.
 
 import os
+import base64
+import concurrent.futures
+import contextlib
 import datetime
+import fnmatch
+import functools
+import glob
+import hashlib
+import json
+import shutil
 
+import pyarrow.parquet as pq
+import torch
 from google.cloud import storage
+from google.cloud.storage import retry as storage_retry
 
 from transformers import AutoTokenizer, XLMRobertaTokenizerFast
-from datasets import load_dataset, load_metric, ReadInstruction
+from datasets import Dataset, DatasetDict, load_dataset, load_from_disk, load_metric, ReadInstruction
 from trainer import metadata
 
 
-def preprocess_function(examples):
+# default rendezvous port when CLUSTER_SPEC does not list one
+DISTRIBUTED_PORT = 29500
+
+
+def cluster_spec():
+    """Reads the node layout of a Vertex AI custom job from the CLUSTER_SPEC
+    environment variable. The first replica of workerpool0 is the master
+    node and the replicas of workerpool1 follow it in rank order.
+
+    Returns:
+      node rank, number of nodes, master address and master port, or
+      a single local node when CLUSTER_SPEC is not set
     """
-    tokenizer = AutoTokenizer.from_pretrained(
-        metadata.PRETRAINED_MODEL_NAME,
-        use_fast=True,
-    )
+    spec = os.getenv("CLUSTER_SPEC")
+    if not spec:
+        return 0, 1, "127.0.0.1", DISTRIBUTED_PORT
+    spec = json.loads(spec)
+    cluster, task = spec["cluster"], spec["task"]
+    pools = sorted(pool for pool in cluster if pool in ("workerpool0", "workerpool1"))
+    nodes = [address for pool in pools for address in cluster[pool]]
+    node_rank = nodes.index(cluster[task["type"]][task["index"]])
+    host, _, port = nodes[0].partition(":")
+    return node_rank, len(nodes), host, int(port or DISTRIBUTED_PORT)
+
+
+def is_distributed():
+    """Whether this process is one rank of a torch distributed job."""
+    return int(os.getenv("WORLD_SIZE", 1)) > 1
+
+
+def is_main_process():
+    """Whether this process is the global rank 0, or the only process."""
+    return int(os.getenv("RANK", 0)) == 0
+
+
+def init_distributed(backend=None):
+    """Joins the process group set up by the launcher, with NCCL on GPUs
+    and gloo on CPU unless `backend` is given.
+    """
+    if not is_distributed() or torch.distributed.is_initialized():
+        return
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.getenv("LOCAL_RANK", 0)))
+    torch.distributed.init_process_group(
+        backend=backend or ("nccl" if torch.cuda.is_available() else "gloo"))
+
+
+def broadcast_from_main(value):
+    """Returns the `value` of the global rank 0 on every rank, so that a
+    decision taken by the first rank is shared by the whole job.
+    """
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        return value
+    objects = [value]
+    torch.distributed.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+@contextlib.contextmanager
+def main_process_first():
+    """Lets the global rank 0 run the body first while the other ranks wait,
+    so that downloads and the tokenized dataset cache are written once and
+    then reused by every rank.
     """
-    tokenizer = XLMRobertaTokenizerFast.from_pretrained(
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    if distributed and not is_main_process():
+        torch.distributed.barrier()
+    yield
+    if distributed and is_main_process():
+        torch.distributed.barrier()
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer():
+    """Returns the tokenizer of the pretrained model.
+
+    The tokenizer is created once per process and reused by every
+    preprocessing batch. `datasets.map` workers forked with `num_proc`
+    inherit the instance of the parent process.
+    """
+    return XLMRobertaTokenizerFast.from_pretrained(
         metadata.PRETRAINED_MODEL_NAME,
     )
 
+
+def preprocess_function(examples, dynamic_padding=False):
+    """Tokenizes a batch of examples.
+
+    With `dynamic_padding` the token ids are stored unpadded together with
+    their `length`, and padding is left to the data collator.
+    """
+    tokenizer = get_tokenizer()
+
     # Tokenize the texts
     tokenizer_args = (
         (examples['text'],)
     )
     result = tokenizer(*tokenizer_args,
-                       padding='max_length',
+                       padding=False if dynamic_padding else 'max_length',
                        max_length=metadata.MAX_SEQ_LENGTH,
                        truncation=True)
+    if dynamic_padding:
+        result["length"] = [len(input_ids) for input_ids in result["input_ids"]]
 
     # TEMP: We can extract this automatically but Unique method of the dataset
     # is not reporting the label -1 which shows up in the pre-processing
@@ -54,31 +150,316 @@ def preprocess_function(examples):
     return result
 
 
+def local_path(uri):
+    """Maps a gs:// URI to its Cloud Storage FUSE mount point. Local paths
+    are returned unchanged.
+
+    Args:
+      uri: local path or gs:// URI
+    """
+    return uri.replace("gs://", "/gcs/", 1) if uri.startswith("gs://") else uri
+
+
+def dataset_cache_key(dataset, dynamic_padding=False):
+    """Returns the content address of the tokenized version of a dataset.
+
+    The key changes whenever the raw dataset, the tokenizer vocabulary, the
+    maximum sequence length, the padding mode or the label map changes.
+
+    Args:
+      dataset: raw `DatasetDict` before tokenization
+      dynamic_padding: whether token ids are stored unpadded
+    """
+    tokenizer = get_tokenizer()
+    vocab = tokenizer.backend_tokenizer.to_str().encode("utf-8")
+    key = {
+        "dataset": {split: dataset[split]._fingerprint for split in sorted(dataset)},
+        "tokenizer": tokenizer.name_or_path,
+        "vocab": hashlib.sha256(vocab).hexdigest(),
+        "max_seq_length": metadata.MAX_SEQ_LENGTH,
+        "dynamic_padding": dynamic_padding,
+        "labels": sorted(metadata.TARGET_LABELS.items()),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _in_test_split(text, test_size):
+    """Assigns a row to the test split from the hash of its text, so that
+    the split is deterministic and needs no shuffle of the full dataset.
+    """
+    digest = hashlib.md5(text.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64 < test_size
+
+
+def _parquet_files(path):
+    """Lists the parquet files of a local or gs:// file or directory."""
+    path = local_path(path)
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.parquet")))
+    return [path]
+
+
+def _parquet_generator(files, text_column, label_column, test_size, batch_size):
+    """Streams (text, label) rows out of parquet files, one record batch at
+    a time and reading only the text and label columns. The "test" column
+    flags the rows of the test split.
+    """
+    for file in files:
+        parquet_file = pq.ParquetFile(file)
+        for batch in parquet_file.iter_batches(batch_size=batch_size,
+                                               columns=[text_column, label_column]):
+            batch = batch.to_pydict()
+            for text, label in zip(batch[text_column], batch[label_column]):
+                if text is None or label is None:
+                    continue
+                yield {"text": text, "label": label, "test": _in_test_split(text, test_size)}
+
+
+def load_parquet_dataset(args):
+    """Loads a local or gs:// parquet file or directory of parquet files
+    into a train/test `DatasetDict`.
+
+    Rows are streamed in a single pass into an on-disk Arrow table, so peak
+    memory does not grow with the size of the dataset, and the splits are
+    filtered out of it.
+
+    Args:
+      args: arguments passed to the python script
+    """
+    files = _parquet_files(args.dataset_path)
+    # the generated table is cached under its arguments, name the cache
+    # after the size and modification time of the files so that rewritten
+    # files are read again
+    stamps = [(f, os.path.getsize(f), os.path.getmtime(f)) for f in files]
+    config_name = "parquet-" + hashlib.sha256(json.dumps(stamps).encode("utf-8")).hexdigest()[:16]
+    rows = Dataset.from_generator(
+        _parquet_generator,
+        gen_kwargs={
+            "files": files,
+            "text_column": args.text_column,
+            "label_column": args.label_column,
+            "test_size": args.test_size,
+            "batch_size": args.preprocess_batch_size,
+        },
+        config_name=config_name)
+    dataset = DatasetDict({
+        "train": rows.filter(lambda test: [not t for t in test], input_columns="test",
+                             batched=True, batch_size=args.preprocess_batch_size),
+        "test": rows.filter(lambda test: test, input_columns="test",
+                            batched=True, batch_size=args.preprocess_batch_size),
+    })
+    return dataset.remove_columns("test")
+
+
+# file written last in a dataset cache entry, entries without it are
+# incomplete and ignored
+CACHE_MARKER = "_SUCCESS"
+
+
+def load_cached_dataset(cache_path):
+    """Returns the dataset cached at `cache_path`, or None when there is no
+    complete cache entry.
+    """
+    if os.path.isfile(os.path.join(cache_path, CACHE_MARKER)):
+        print(f"Loading cached dataset from {cache_path}")
+        return load_from_disk(cache_path)
+    return None
+
+
+def save_cached_dataset(dataset, cache_path):
+    """Writes a dataset to the cache entry `cache_path` and returns it
+    memory-mapped from there.
+
+    The shards are written in place and the marker file last, as directory
+    renames are neither atomic nor always allowed on the /gcs/ mount. Jobs
+    writing the same entry at the same time write the same shards. When the
+    entry cannot be written, the dataset is returned as is.
+    """
+    try:
+        dataset.save_to_disk(cache_path)
+        with open(os.path.join(cache_path, CACHE_MARKER), "w") as f:
+            f.write("")
+    except OSError as e:
+        print(f"Could not cache the dataset at {cache_path}: {e}")
+        return dataset
+    print(f"Saved cached dataset at {cache_path}")
+    return load_from_disk(cache_path)
+
+
 def load_data(args):
     """Loads the data into two different data loaders. (Train, Test)
 
+    When `args.dataset_cache_dir` is set, the tokenized dataset is stored
+    there as Arrow shards keyed on `dataset_cache_key`, and later jobs
+    memory-map the shards instead of tokenizing again.
+
         Args:
             args: arguments passed to the python script
     """
+    dynamic_padding = args.dynamic_padding == "y"
+
     # Dataset loading repeated here to make this cell idempotent
     # Since we are over-writing datasets variable
-    dataset = load_dataset(metadata.DATASET_NAME)
+    if args.dataset_path:
+        dataset = load_parquet_dataset(args)
+    else:
+        dataset = load_dataset(metadata.DATASET_NAME)
 
+    cache_path = None
+    if args.dataset_cache_dir:
+        cache_path = os.path.join(local_path(args.dataset_cache_dir),
+                                  dataset_cache_key(dataset, dynamic_padding))
+        cached = load_cached_dataset(cache_path)
+        if cached is not None:
+            return cached["train"], cached["test"]
+
+    # build the tokenizer before map() so that forked workers reuse it
+    get_tokenizer()
     dataset = dataset.map(preprocess_function,
                           batched=True,
+                          fn_kwargs={"dynamic_padding": dynamic_padding},
+                          batch_size=args.preprocess_batch_size,
+                          num_proc=args.preprocess_num_proc,
                           load_from_cache_file=True)
 
+    if cache_path:
+        dataset = save_cached_dataset(dataset, cache_path)
+
     train_dataset, test_dataset = dataset["train"], dataset["test"]
 
     return train_dataset, test_dataset
 
 
+def count_tokens(dataset, batch_size=10000):
+    """Counts the non-padding tokens of a tokenized dataset, reading the
+    attention masks one batch at a time.
+
+    Args:
+      dataset: tokenized `Dataset`
+      batch_size: number of examples read at a time
+    """
+    if "length" in dataset.column_names:
+        return sum(dataset["length"])
+    num_tokens = 0
+    for batch in dataset.select_columns(["attention_mask"]).iter(batch_size=batch_size):
+        num_tokens += sum(sum(mask) for mask in batch["attention_mask"])
+    return num_tokens
+
+
+# chunk size of resumable uploads, a multiple of 256 KB as required by GCS
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+# retry policy of each request of an upload: a failed chunk of a resumable
+# upload is retried in the same session, from the last committed offset
+UPLOAD_RETRY = storage_retry.DEFAULT_RETRY.with_deadline(600)
+
+
+class LocalBucket(object):
+    """Local directory exposing the subset of the `storage.Bucket` interface
+    used by `upload_directory`. It mirrors uploads into a local file system,
+    e.g. to export the model to a mounted volume or to test the uploader
+    without GCS.
+    """
+
+    def __init__(self, root):
+        self.name = root
+
+    def get_blob(self, name):
+        path = os.path.join(self.name, name)
+        return LocalBlob(path) if os.path.isfile(path) else None
+
+    def blob(self, name):
+        return LocalBlob(os.path.join(self.name, name))
+
+
+class LocalBlob(object):
+    """Local file exposing the subset of the `storage.Blob` interface used by
+    `upload_directory`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.chunk_size = None
+
+    @property
+    def md5_hash(self):
+        return file_md5(self.path) if os.path.isfile(self.path) else None
+
+    def upload_from_filename(self, filename, retry=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+
+def file_md5(path):
+    """Returns the base64 encoded MD5 digest of a file, in the format of the
+    `md5_hash` of a GCS object.
+    """
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode("utf-8")
+
+
+def _upload_file(bucket, local_file, name):
+    """Uploads a single file unless the remote object already has the same
+    checksum. Large files are sent as chunked resumable uploads, whose failed
+    chunks are retried with exponential backoff without sending the
+    committed chunks again.
+
+    Returns:
+      True if the file was uploaded, False if it was skipped
+    """
+    remote = bucket.get_blob(name)
+    if remote is not None and remote.md5_hash == file_md5(local_file):
+        return False
+
+    blob = bucket.blob(name)
+    if os.path.getsize(local_file) > UPLOAD_CHUNK_SIZE:
+        blob.chunk_size = UPLOAD_CHUNK_SIZE
+    # uploads without a generation precondition are not retried by
+    # default, pass the policy explicitly
+    blob.upload_from_filename(local_file, retry=UPLOAD_RETRY)
+    return True
+
+
+def upload_directory(local_dir, bucket, prefix, max_workers=8, exclude=("checkpoint-*",)):
+    """Uploads a local directory recursively with a pool of threads.
+
+    Args:
+      local_dir: local directory to upload
+      bucket: `storage.Bucket` or `LocalBucket` to upload to
+      prefix: object name prefix of the uploaded files
+      max_workers: number of concurrent uploads
+      exclude: glob patterns of the subdirectories left out, by default the
+        training checkpoints with their optimizer and scheduler state
+
+    Returns:
+      number of uploaded and skipped files
+    """
+    uploads = []
+    for root, dirs, files in os.walk(local_dir):
+        # prune excluded directories before os.walk descends into them
+        dirs[:] = [d for d in dirs if not any(fnmatch.fnmatch(d, pattern) for pattern in exclude)]
+        for file in files:
+            local_file = os.path.join(root, file)
+            relative_path = os.path.relpath(local_file, local_dir).replace(os.sep, "/")
+            name = "/".join([prefix, relative_path]) if prefix else relative_path
+            uploads.append((local_file, name))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda upload: _upload_file(bucket, *upload), uploads))
+
+    uploaded = sum(results)
+    return uploaded, len(results) - uploaded
+
+
 def save_model(args):
     """Saves the model to Google Cloud Storage or local file system
 
     Args:
       args: contains name for saved model.
     """
+    model_dir = os.path.join("/tmp", args.model_name)
     scheme = 'gs://'
     if args.job_dir.startswith(scheme):
         job_dir = args.job_dir.split("/")
@@ -91,15 +472,11 @@ def save_model(args):
             model_path = '{}'.format(args.model_name)
 
         bucket = storage.Client().bucket(bucket_name)
-        local_path = os.path.join("/tmp", args.model_name)
-        files = [f for f in os.listdir(local_path) if os.path.isfile(os.path.join(local_path, f))]
-        for file in files:
-            local_file = os.path.join(local_path, file)
-            blob = bucket.blob("/".join([model_path, file]))
-            blob.upload_from_filename(local_file)
-        print(f"Saved model files in gs://{bucket_name}/{model_path}")
+        uploaded, skipped = upload_directory(model_dir, bucket, model_path, args.upload_workers)
+        print(f"Saved model files in gs://{bucket_name}/{model_path} "
+              f"({uploaded} uploaded, {skipped} unchanged)")
     else:
-        print(f"Saved model files at {os.path.join('/tmp', args.model_name)}")
-        print(f"To save model files in GCS bucket, please specify job_dir starting with gs://")
-
-
+        bucket = LocalBucket(args.job_dir)
+        uploaded, skipped = upload_directory(model_dir, bucket, args.model_name, args.upload_workers)
+        print(f"Saved model files at {os.path.join(args.job_dir, args.model_name)} "
+              f"({uploaded} copied, {skipped} unchanged)")